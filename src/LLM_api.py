@@ -1,39 +1,165 @@
 import os
 import time
 import datetime
-from groq import Groq
-from ratelimit import limits, sleep_and_retry
+import itertools
+import threading
+from concurrent.futures import Future
+from llm_cache import LLMCache
+from llm_backends import get_backend, resolve_route
+from metrics import metrics
+from prompt_budget import count_tokens
+from llm_scheduler import LLMScheduler, SharedTokenBucket, NORMAL
+from tracing import trace_function_calls
+from planning_budget import charge_budget, BudgetExhausted
 
-# Define the rate limit (10 calls per minute)
+# Define the rate limit (10 calls per minute), shared by every process using the same bucket file
 CALLS = 10
 RATE_LIMIT = 60
+RATE_LIMIT_PATH = os.environ.get("LLM_RATE_LIMIT_PATH", "cache/rate_limit.sqlite")
 
-@sleep_and_retry
-@limits(calls=CALLS, period=RATE_LIMIT)
-def call_groq_api(prompt, max_tokens=None, temperature=1.0, strip=False):
-    retries = 3
-    delay = 5
+scheduler = LLMScheduler(SharedTokenBucket(RATE_LIMIT_PATH, CALLS, RATE_LIMIT))
 
-    client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
+SYSTEM_PROMPT = "You are a helpful assistant."
 
-    while retries > 0:
+LOG_DIR = "logs"
+
+# Response cache, keyed on everything that is sent to the model (LLM_CACHE_DISABLED=1 bypasses it,
+# LLM_CACHE_REFRESH=1 replaces the entries of earlier runs)
+CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "cache/llm_cache.sqlite")
+CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 5000))
+CACHE_MAX_AGE = int(os.environ.get("LLM_CACHE_MAX_AGE", 7 * 24 * 3600))
+
+response_cache = LLMCache(CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, max_age=CACHE_MAX_AGE,
+                          enabled=not os.environ.get("LLM_CACHE_DISABLED"))
+if os.environ.get("LLM_CACHE_REFRESH"):
+    response_cache.refresh()
+
+# Identical prompts that are in flight at the same time share a single request
+in_flight_requests = {}
+in_flight_lock = threading.Lock()
+
+
+def call_groq_api(prompt, max_tokens=None, temperature=1.0, strip=False, use_cache=True, refresh=False,
+                  priority=NORMAL, call_site="default", variant=0, json_mode=False):
+    # use_cache=False skips the cache entirely, refresh=True forces a new completion and overwrites the entry.
+    # Different variants of one prompt are independent samples that are cached and coalesced separately.
+    # json_mode asks the backend to constrain the output to a JSON object
+    route = resolve_route(call_site)
+    if max_tokens is None:
+        max_tokens = route.max_tokens
+    model = f"{route.backend}:{route.model}:json" if json_mode else f"{route.backend}:{route.model}"
+    key = LLMCache.make_key(model, SYSTEM_PROMPT, prompt, temperature, max_tokens, variant)
+    start = time.perf_counter()
+
+    if use_cache and not refresh:
+        cached = response_cache.get(key)
+        if cached is not None:
+            metrics.record_llm_call(call_site, time.perf_counter() - start, cache_hit=True)
+            return cached.strip() if strip else cached
+
+    with in_flight_lock:
+        future = in_flight_requests.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            in_flight_requests[key] = future
+
+    if not owner:
+        # Served by the identical request already in flight
         try:
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                model="llama3-70b-8192",
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
-            return chat_completion.choices[0].message.content.strip() if strip else chat_completion
-        except Exception as e:
-            print(f"Error encountered: {e}. Retrying in {delay} seconds...")
-            retries -= 1
-            time.sleep(delay)
-
-    raise Exception("Failed to get a response from Groq API after multiple retries.")
+            content = future.result()
+        except BudgetExhausted:
+            # Refused by the budget of the plan that sent it, which need not be ours
+            return call_groq_api(prompt, max_tokens, temperature, strip, use_cache, refresh, priority, call_site,
+                                 variant, json_mode)
+        metrics.record_llm_call(call_site, time.perf_counter() - start, cache_hit=True)
+        return content.strip() if strip else content
+
+    stats = {}
+    completion = None
+    refused = False
+    try:
+        completion = request_completion(prompt, route, max_tokens, temperature, priority, stats, json_mode)
+        content = completion.content
+        future.set_result(content)
+        # Cached before the request leaves in_flight_requests, so an identical call arriving in between finds one
+        # or the other instead of sending the request again
+        if use_cache:
+            response_cache.set(key, content)
+    except Exception as e:
+        # Calls refused by the planning budget were never sent and are not recorded
+        refused = isinstance(e, BudgetExhausted)
+        future.set_exception(e)
+        raise
+    finally:
+        with in_flight_lock:
+            in_flight_requests.pop(key, None)
+        if not refused:
+            metrics.record_llm_call(call_site, time.perf_counter() - start, retries=stats.get("retries", 0),
+                                    rate_limit_wait=stats.get("rate_limit_wait", 0.0),
+                                    prompt_tokens=completion.prompt_tokens if completion else 0,
+                                    completion_tokens=completion.completion_tokens if completion else 0)
+        if completion is not None:
+            charge_budget(completion.prompt_tokens, completion.completion_tokens)
+
+    return content.strip() if strip else content
+
+
+def stream_groq_api(prompt, max_tokens=None, temperature=1.0, use_cache=True, refresh=False, priority=NORMAL,
+                    call_site="default"):
+    # Yields the completion in chunks as they arrive; shares cache entries with call_groq_api
+    route = resolve_route(call_site)
+    if max_tokens is None:
+        max_tokens = route.max_tokens
+    key = LLMCache.make_key(f"{route.backend}:{route.model}", SYSTEM_PROMPT, prompt, temperature, max_tokens)
+    start = time.perf_counter()
+
+    if use_cache and not refresh:
+        cached = response_cache.get(key)
+        if cached is not None:
+            metrics.record_llm_call(call_site, time.perf_counter() - start, cache_hit=True)
+            yield cached
+            return
+
+    backend = get_backend(route.backend)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+    def open_stream():
+        # The first chunk is read under the scheduler, so connection errors and 429s are retried
+        chunks = backend.stream(messages, route.model, max_tokens, temperature)
+        first = next(chunks, "")
+        return itertools.chain([first], chunks)
+
+    stats = {}
+    chunks = scheduler.submit(open_stream, priority, stats)
+    content = []
+    for chunk in chunks:
+        content.append(chunk)
+        yield chunk
+    content = "".join(content)
+
+    # Streams carry no usage information, so token counts are local estimates
+    metrics.record_llm_call(call_site, time.perf_counter() - start, retries=stats.get("retries", 0),
+                            rate_limit_wait=stats.get("rate_limit_wait", 0.0), prompt_tokens=count_tokens(prompt),
+                            completion_tokens=count_tokens(content))
+    charge_budget(count_tokens(prompt), count_tokens(content))
+    if use_cache:
+        response_cache.set(key, content)
+
+
+@trace_function_calls
+def request_completion(prompt, route, max_tokens=None, temperature=1.0, priority=NORMAL, stats=None,
+                       json_mode=False):
+    backend = get_backend(route.backend)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    return scheduler.submit(lambda: backend.complete(messages, route.model, max_tokens, temperature, json_mode),
+                            priority, stats)
 
 updated_log_files = {}
 
@@ -41,7 +167,7 @@ updated_log_files = {}
 def log_response(function_name, response):
     global updated_log_files
 
-    log_dir = "logs"
+    log_dir = LOG_DIR
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
@@ -1,16 +1,22 @@
 import datetime
 import os
+import threading
 from LLM_api import call_groq_api, log_response
-from text_utils import trace_function_calls
-from nltk.stem import WordNetLemmatizer
+from llm_scheduler import HOUSEKEEPING
+from tracing import trace_function_calls
+from task_classifier import confident_verdict, log_classifier_example
+from prompt_budget import budget_sections
+
+STATE_CHANGES_DIR = "../state_changes"
 
 @trace_function_calls
 def groq_is_goal(state, goal_task):
-    prompt = (f"Given the current state '{state}' and the goal '{goal_task}', "
+    sections = budget_sections("groq_is_goal", state=state)
+    prompt = (f"Given the current state '{sections['state']}' and the goal '{goal_task}', "
               f"determine if the current state satisfies the goal. "
               f"Please provide the answer as 'True' or 'False':")
 
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="groq_is_goal")
 
     log_response("groq_is_goal", response)
     return response.lower() == "true"
@@ -19,23 +25,44 @@ def groq_is_goal(state, goal_task):
 def get_initial_task(goal):
     prompt = f"Given the goal '{goal}', suggest a high level task that will complete it:"
 
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="get_initial_task")
     log_response("get_initial_task", response)
     return response
 
+_lemmatizer = None
+_lemmatizer_lock = threading.Lock()
+
+def get_lemmatizer():
+    # nltk and the WordNet corpus take a while to load, so both are loaded on first use (or by the warm-up)
+    global _lemmatizer
+    with _lemmatizer_lock:
+        if _lemmatizer is None:
+            from nltk.stem import WordNetLemmatizer
+
+            lemmatizer = WordNetLemmatizer()
+            # The corpus itself is only read by the first lemmatize call, which is not thread-safe
+            lemmatizer.lemmatize("tasks")
+            _lemmatizer = lemmatizer
+        return _lemmatizer
+
+primitive_actions_keywords = {
+    'grab', 'reach', 'twist', 'move', 'push', 'pull', 'lift', 'hold',
+    'release', 'turn', 'rotate', 'locate', 'identify', 'find', 'pick',
+    'place', 'put', 'insert', 'remove', 'open', 'close', 'clean',
+    'wipe', 'sweep', 'mop', 'vacuum', 'wash', 'rinse', 'cook', 'heat',
+    'boil', 'fry', 'bake', 'microwave', 'cut', 'slice', 'dice', 'chop', 'examine',
+    'grate', 'peel', 'mix', 'blend', 'stir', 'pour', 'serve', 'stop', 'scan', 'activate'
+}
+
 @trace_function_calls
 def is_task_primitive(task_name):
-    lemmatizer = WordNetLemmatizer()
+    # Confident local verdicts come first, the keyword check decides the rest
+    verdict = confident_verdict("primitive", task_name)
+    if verdict is not None:
+        return verdict
+
     task_words = task_name.lower().split()
-    
-    primitive_actions_keywords = [
-        'grab', 'reach', 'twist', 'move', 'push', 'pull', 'lift', 'hold',
-        'release', 'turn', 'rotate', 'locate', 'identify', 'find', 'pick',
-        'place', 'put', 'insert', 'remove', 'open', 'close', 'clean',
-        'wipe', 'sweep', 'mop', 'vacuum', 'wash', 'rinse', 'cook', 'heat',
-        'boil', 'fry', 'bake', 'microwave', 'cut', 'slice', 'dice', 'chop', 'examine',
-        'grate', 'peel', 'mix', 'blend', 'stir', 'pour', 'serve', 'stop', 'scan', 'activate'
-    ]
+    lemmatizer = get_lemmatizer()
 
     for word in task_words:
         lemma = lemmatizer.lemmatize(word)
@@ -47,22 +74,29 @@ def is_task_primitive(task_name):
 @trace_function_calls
 def compress_capabilities(text):
     prompt = f"Compress the capabilities description '{text}' into a more concise form:"
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, priority=HOUSEKEEPING, call_site="compress_capabilities")
     return response
 
 @trace_function_calls
 def can_execute(task, capabilities, state):
-    prompt = (f"Given the task '{task}', the capabilities '{capabilities}', "
-              f"and the state '{state}', determine if the task can be executed. "
+    # Confident local verdicts skip the LLM
+    verdict = confident_verdict("executable", task, state, capabilities)
+    if verdict is not None:
+        return verdict
+
+    sections = budget_sections("can_execute", capabilities=capabilities, state=state)
+    prompt = (f"Given the task '{task}', the capabilities '{sections['capabilities']}', "
+              f"and the state '{sections['state']}', determine if the task can be executed. "
               f"Please provide the answer as 'True' or 'False':")
 
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="can_execute")
 
     log_response("can_execute", response)
+    log_classifier_example("executable", task, state, response.lower() == "true", capabilities)
     return response.lower() == "true"
 
 def log_state_change(prev_state, new_state, task):
-    log_dir = "../state_changes"
+    log_dir = STATE_CHANGES_DIR
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
@@ -0,0 +1,250 @@
+# Asyncio variant of the HTN planner
+# LLM calls that do not depend on each other are sent concurrently: the executability checks of all primitive
+# siblings, and (speculatively) the decomposition of non-primitive siblings. A speculative decomposition is only
+# kept if the state it started from turns out to be the state the sibling is actually reached with.
+
+import asyncio
+import contextvars
+from collections import Counter, defaultdict
+
+from LLM_utils import is_task_primitive, can_execute
+from htn_planner import HTNPlanner, REPAIR_ATTEMPTS
+from llm_scheduler import current_priority, SPECULATIVE
+from metrics import measure_decompose
+from planning_budget import BudgetExhausted
+from task_node import TaskNode
+from tracing import trace_function_calls
+from vector_db import VectorDB
+from world_state import WorldState
+
+# Repair bookkeeping of the speculative decomposition running in this context. It is kept apart from the plan's, so
+# that discarded speculations leave no failed attempts or used-up repairs behind, and is merged in when grafted
+speculation_repairs = contextvars.ContextVar("speculation_repairs", default=None)
+# Decompositions completed by that speculation, stored in the plan library only when it is grafted: they were made
+# from a guessed state
+speculated_decompositions = contextvars.ContextVar("speculated_decompositions", default=None)
+
+
+def next_candidate(candidates):
+    # Streamed subtasks are collected on the worker thread; siblings are scheduled together anyway
+    candidate = next(candidates, None)
+    return list(candidate) if candidate is not None else None
+
+
+class AsyncHTNPlanner(HTNPlanner):
+    def __init__(self, goal_input, initial_state, goal_task, capabilities_input, max_depth=5,
+                 send_update_callback=None, reuse_plans=True, batch_classification=False, streaming=False,
+                 candidates=1, candidate_threshold=0.8, speculative=True, db=None, repair_attempts=REPAIR_ATTEMPTS,
+                 budget=None):
+        super().__init__(goal_input, initial_state, goal_task, capabilities_input, max_depth, send_update_callback,
+                         reuse_plans, batch_classification, streaming, candidates, candidate_threshold, db=db,
+                         repair_attempts=repair_attempts, budget=budget)
+        self.speculative = speculative
+
+    def plan_once(self):
+        return asyncio.run(self.htn_planning_async())
+
+    async def htn_planning_async(self):
+        db = self.db or VectorDB.shared()
+        root_node = TaskNode(self.goal_input)
+        self.root_node = root_node
+
+        print(f"Initial goal: {self.goal_task}")
+        success, _ = await self.decompose_async(root_node, WorldState.from_text(self.initial_state), 0, self.max_depth,
+                                                self.capabilities_input, self.goal_task, db, self.send_update_callback)
+
+        if success and root_node.status in ("completed", "unexpanded"):
+            print("Plan found successfully!")
+            return root_node
+        else:
+            print("Failed to find a valid plan.")
+            return None
+
+    @trace_function_calls
+    @measure_decompose
+    async def decompose_async(self, task_node, state, depth, max_depth, capabilities_input, goal_state, db,
+                              send_update_callback=None, task_history=None):
+        task = task_node.task_name
+        decompose_state = WorldState.from_text(state)
+
+        print(f"Decomposing task (depth {depth}/{max_depth}): {task}")
+
+        if depth > max_depth:
+            print(f"Max depth reached for task: {task}")
+            task_node.status = "failed"
+            if send_update_callback:
+                send_update_callback(task_node)
+            return False, decompose_state
+
+        if self.leave_unexpanded(task_node, depth, send_update_callback):
+            return True, decompose_state
+
+        try:
+            # As in HTNPlanner.decompose: the candidates in order, then repairs until the repair budget runs out.
+            # Only this subtree is redone, from the state it started in; completed siblings are kept
+            candidates = iter(await asyncio.to_thread(self.subtask_candidates, task, decompose_state,
+                                                      max_depth - depth, capabilities_input, db, task_history))
+            attempt = 0
+            while True:
+                subtasks_list = await asyncio.to_thread(next_candidate, candidates)
+                if subtasks_list is None:
+                    subtasks_list = await asyncio.to_thread(self.repair_subtasks, task, decompose_state,
+                                                            max_depth - depth, capabilities_input, task_history)
+                if subtasks_list is None:
+                    if self.out_of_budget() and self.expand_limit is not None:
+                        self.remove_children(task_node, send_update_callback)
+                        self.leave_unexpanded(task_node, depth, send_update_callback)
+                        return True, decompose_state
+                    task_node.status = "failed"
+                    if send_update_callback:
+                        send_update_callback(task_node)
+                    return False, decompose_state
+                if attempt:
+                    print(f"Falling back to the next decomposition for {task}")
+                    self.remove_children(task_node, send_update_callback)
+                attempt += 1
+
+                success, updated_state = await self.decompose_subtasks_async(
+                    task_node, subtasks_list, decompose_state, depth, max_depth, capabilities_input, goal_state, db,
+                    send_update_callback, task_history)
+                if success:
+                    break
+                self.record_failed_attempt(task, subtasks_list)
+        except BudgetExhausted as e:
+            self.refused_by_budget(task_node, e, send_update_callback)
+            return True, decompose_state
+
+        task_node.status = "completed"
+        if send_update_callback:
+            send_update_callback(task_node)
+
+        self.record_decomposition(task_node, state, capabilities_input, db)
+
+        print(f"Task completed: {task}")
+        return True, updated_state
+
+    async def decompose_subtasks_async(self, task_node, subtasks_list, decompose_state, depth, max_depth,
+                                       capabilities_input, goal_state, db, send_update_callback, task_history):
+        task = task_node.task_name
+        print(f"Subtasks for {task}: {subtasks_list}")
+
+        if not subtasks_list:
+            print(f"No valid subtasks found for {task}")
+            return False, decompose_state
+
+        task_node.status = "in-progress"
+        if send_update_callback:
+            send_update_callback(task_node)
+
+        subtask_nodes = []
+        for subtask in subtasks_list:
+            subtask_node = TaskNode(subtask, parent=task_node)
+            task_node.add_child(subtask_node)
+            subtask_nodes.append(subtask_node)
+
+        verdicts = await asyncio.to_thread(self.classify_subtasks, subtasks_list, capabilities_input, decompose_state)
+        primitive = [verdict["primitive"] if verdict else is_task_primitive(subtask)
+                     for subtask, verdict in zip(subtasks_list, verdicts)]
+
+        # All primitive siblings without a verdict are checked against the state the parent was entered with
+        checks = {
+            index: asyncio.create_task(asyncio.to_thread(can_execute, subtask, capabilities_input,
+                                                         decompose_state.relevant_to(subtask)))
+            for index, subtask in enumerate(subtasks_list) if primitive[index] and not verdicts[index]
+        }
+        speculations = {}
+        if self.speculative:
+            for index, subtask in enumerate(subtasks_list):
+                if not primitive[index]:
+                    speculations[index] = (decompose_state, asyncio.create_task(
+                        self.speculate(subtask, decompose_state, depth + 1, max_depth, capabilities_input,
+                                       goal_state, db, task_history)))
+
+        try:
+            for index, subtask_node in enumerate(subtask_nodes):
+                subtask = subtask_node.task_name
+
+                try:
+                    if self.out_of_budget():
+                        subtask_node.status = "unexpanded"
+                    elif primitive[index]:
+                        if verdicts[index]["executable"] if verdicts[index] else await checks[index]:
+                            print(f"Executing task: {subtask}")
+                            decompose_state = await asyncio.to_thread(self.execute_task, decompose_state, subtask)
+                            subtask_node.status = "completed"
+                    else:
+                        success, updated_state = await self.decompose_sibling(
+                            subtask_node, speculations.pop(index, None), decompose_state, depth + 1, max_depth,
+                            capabilities_input, goal_state, db, send_update_callback, task_history)
+                        if success:
+                            decompose_state = updated_state
+                        else:
+                            subtask_node.status = "failed"
+                except BudgetExhausted as e:
+                    self.refused_by_budget(subtask_node, e)
+
+                if send_update_callback:
+                    send_update_callback(subtask_node)
+
+                if subtask_node.status == "failed":
+                    return False, decompose_state
+        finally:
+            for pending in list(checks.values()) + [speculation for _, speculation in speculations.values()]:
+                pending.cancel()
+
+        return True, decompose_state
+
+    async def speculate(self, subtask, state, depth, max_depth, capabilities_input, goal_state, db, task_history):
+        # Decomposed on a detached node without UI updates; the result is grafted in only if it is still valid.
+        # Runs in its own task, so the lowered priority only applies to calls made on behalf of the speculation
+        current_priority.set(SPECULATIVE)
+        repair_state = (defaultdict(list), Counter())
+        speculation_repairs.set(repair_state)
+        decompositions = []
+        speculated_decompositions.set(decompositions)
+        detached_node = TaskNode(subtask)
+        success, updated_state = await self.decompose_async(detached_node, state, depth, max_depth,
+                                                            capabilities_input, goal_state, db, None, task_history)
+        return success, updated_state, detached_node, repair_state, decompositions
+
+    def record_decomposition(self, task_node, state, capabilities_input, db):
+        decompositions = speculated_decompositions.get()
+        if decompositions is None:
+            super().record_decomposition(task_node, state, capabilities_input, db)
+        else:
+            decompositions.append((task_node, state, capabilities_input))
+
+    def repair_state(self):
+        return speculation_repairs.get() or super().repair_state()
+
+    def merge_repairs(self, repair_state):
+        failed_decompositions, repairs = self.repair_state()
+        speculated_failures, speculated_repairs = repair_state
+        for task, attempts in speculated_failures.items():
+            for subtasks in attempts:
+                if subtasks not in failed_decompositions[task]:
+                    failed_decompositions[task].append(subtasks)
+        repairs.update(speculated_repairs)
+
+    async def decompose_sibling(self, subtask_node, speculation, state, depth, max_depth, capabilities_input,
+                                goal_state, db, send_update_callback, task_history):
+        if speculation is not None:
+            speculated_state, speculation_task = speculation
+            if speculated_state == state:
+                success, updated_state, detached_node, repair_state, decompositions = await speculation_task
+                self.merge_repairs(repair_state)
+                for child in list(detached_node.children):
+                    detached_node.remove_child(child)
+                    subtask_node.add_child(child)
+                subtask_node.status = detached_node.status
+                # Recorded by the enclosing speculation, if any, or stored now
+                for task_node, stored_state, stored_capabilities in decompositions:
+                    self.record_decomposition(subtask_node if task_node is detached_node else task_node,
+                                              stored_state, stored_capabilities, db)
+                return success, updated_state
+
+            print(f"State changed before {subtask_node.task_name}, discarding speculative decomposition")
+            speculation_task.cancel()
+
+        return await self.decompose_async(subtask_node, state, depth, max_depth, capabilities_input, goal_state,
+                                          db, send_update_callback, task_history)
@@ -0,0 +1,294 @@
+# Offline planner benchmark
+# Runs the planner over the scenarios in benchmark_scenarios.json against the mock LLM backend and writes one JSON
+# result file per run, so that call counts, tokens and planner overhead can be compared between commits.
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+#   python benchmark.py --record recording.json     run against the real backend and keep its completions
+#   python benchmark.py --replay recording.json     replay them instead of the scripted answers
+#   python benchmark.py --trace trace.json          also write a Chrome trace of every planner call
+#
+# Scripted answers: get_subtasks returns the scenario's decomposition of a task (tasks without one are
+# primitive), executability checks succeed unless the task is listed in not_executable, and executing a task adds
+# the scenario's effects for it, or "done <task>". Repair requests, which list the failed decompositions, get the
+# scenario's repairs for the task instead.
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import LLM_api
+import LLM_utils
+import text_utils
+import task_classifier
+from llm_backends import MockBackend, RecordingBackend, register_backend, set_default_backend, get_backend
+from llm_scheduler import SharedTokenBucket
+from metrics import metrics, COUNTERS
+from tracing import tracer
+from htn_planner import HTNPlanner
+from planning_budget import PlanningBudget
+from async_htn_planner import AsyncHTNPlanner
+from vector_db import VectorDB
+
+SCENARIOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_scenarios.json")
+RESULT_FORMAT = "htn-benchmark"
+RESULT_VERSION = 1
+COMPARED_FIELDS = ("llm_calls", "prompt_tokens", "completion_tokens", "wall_time", "planner_overhead", "tree_size")
+
+TASK_PATTERN = re.compile(r"the task '(.*?)'", re.S)
+SUBTASK_LINE_PATTERN = re.compile(r"^\s*\d+\. (.*)$", re.M)
+
+# Logs the planner writes during a run, moved into the run's work directory: scripted verdicts must not end up in
+# the classifier examples and state changes the task classifier is trained on
+LOG_PATHS = (
+    (LLM_api, "LOG_DIR", "logs"),
+    (LLM_utils, "STATE_CHANGES_DIR", "state_changes"),
+    (text_utils, "PARSING_ERRORS_DIR", "parsing_errors"),
+    (task_classifier, "EXAMPLES_PATH", os.path.join("logs", "classifier_examples.jsonl")),
+)
+
+
+class ScriptedResponder:
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.decompositions = scenario.get("decompositions", {})
+        self.not_executable = set(scenario.get("not_executable", []))
+        self.effects = scenario.get("effects", {})
+        self.repairs = scenario.get("repairs", {})
+
+    def task(self, prompt):
+        match = TASK_PATTERN.search(prompt)
+        return match.group(1) if match else ""
+
+    def __call__(self, prompt):
+        if "decompose the task" in prompt:
+            task = self.task(prompt)
+            if "already tried and failed" in prompt and task in self.repairs:
+                return repr(self.repairs[task])
+            return repr(self.decompositions.get(task, []))
+        if "classify each of the following subtasks" in prompt:
+            subtasks = SUBTASK_LINE_PATTERN.findall(prompt)
+            return json.dumps([{"subtask": subtask, "primitive": subtask not in self.decompositions,
+                                "executable": subtask not in self.not_executable, "reason": "scripted"}
+                               for subtask in subtasks])
+        if "list the facts that change" in prompt:
+            task = self.task(prompt)
+            return json.dumps(self.effects.get(task, {"add": [f"done {task}"], "delete": []}))
+        if "determine if the task can be executed" in prompt:
+            return "False" if self.task(prompt) in self.not_executable else "True"
+        if "granular enough" in prompt:
+            return "No" if self.task(prompt) in self.decompositions else "Yes"
+        if "determine if the current state satisfies the goal" in prompt:
+            return "False"
+        if "Return a score between 0 and 1" in prompt:
+            return "0.90000000"
+        if "Return 'True' if they meet the requirements" in prompt:
+            return "True"
+        if "suggest a high level task" in prompt:
+            return self.scenario.get("goal_task", self.scenario["goal"])
+        if "Compress the capabilities description" in prompt:
+            return self.scenario["capabilities"]
+        if "translate the task" in prompt:
+            return self.task(prompt)
+        return None
+
+
+def tree_stats(node):
+    size = leaves = depth = unexpanded = 0
+    for current, level in node.walk():
+        size += 1
+        depth = max(depth, level)
+        if not current.children:
+            leaves += 1
+        if current.status == "unexpanded":
+            unexpanded += 1
+    return {"tree_size": size, "leaves": leaves, "depth": depth, "unexpanded": unexpanded}
+
+
+def run_scenario(scenario, args, recording):
+    if args.record:
+        backend = RecordingBackend(get_backend(args.record_backend), recording)
+    else:
+        backend = MockBackend(None if args.replay else ScriptedResponder(scenario), recording, args.latency)
+    register_backend("benchmark", backend)
+
+    planner_class = AsyncHTNPlanner if args.async_planner else HTNPlanner
+    with tempfile.TemporaryDirectory() as plan_library:
+        # A fresh plan library per scenario, so that results do not depend on the order of the scenarios
+        goal_task = scenario.get("goal_task", scenario["goal"])
+        planner = planner_class(scenario["goal"], scenario["initial_state"], goal_task, scenario["capabilities"],
+                                scenario.get("max_depth", 5),
+                                reuse_plans=args.reuse_plans, batch_classification=args.batch_classification,
+                                streaming=args.streaming, candidates=args.candidates,
+                                db=VectorDB(persist_directory=plan_library),
+                                budget=PlanningBudget.from_options(args.deadline, args.max_calls, args.max_tokens))
+
+        before = metrics.snapshot()
+        start = time.perf_counter()
+        plan = planner.htn_planning()
+        wall_time = time.perf_counter() - start
+        summary = metrics.summary_since(before)
+
+    totals = dict.fromkeys(COUNTERS, 0)
+    for counters in summary.values():
+        for name in COUNTERS:
+            totals[name] += counters[name]
+
+    result = {
+        "scenario": scenario["name"],
+        "success": plan is not None,
+        "llm_calls": totals["calls"] - totals["cache_hits"],
+        "cache_hits": totals["cache_hits"],
+        "prompt_tokens": totals["prompt_tokens"],
+        "completion_tokens": totals["completion_tokens"],
+        "prompt_tokens_saved": totals["prompt_tokens_saved"],
+        "wall_time": round(wall_time, 4),
+        "llm_time": round(totals["latency"], 4),
+        # Only meaningful for the sequential planner; concurrent calls overlap in wall time
+        "planner_overhead": round(max(wall_time - totals["latency"], 0.0), 4),
+        "calls_by_site": {call_site: counters["calls"] for call_site, counters in sorted(summary.items())},
+        "unanswered_prompts": getattr(backend, "unanswered", 0),
+        "repairs": sum(planner.repairs.values()),
+    }
+    # Failed runs return no plan, the tree they built up to the failure is measured instead
+    result.update(tree_stats(planner.root_node))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {result["scenario"]: result for result in json.load(baseline_file)["results"]}
+
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        previous = baseline.get(result["scenario"])
+        if previous is None:
+            print(f"  {result['scenario']:<24} not in baseline")
+            continue
+        changes = []
+        for field in COMPARED_FIELDS:
+            old, new = previous.get(field, 0), result[field]
+            if old != new:
+                change = f" ({(new - old) / old * 100:+.0f}%)" if old else ""
+                changes.append(f"{field} {old} -> {new}{change}")
+        print(f"  {result['scenario']:<24} {', '.join(changes) if changes else 'unchanged'}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the planner against a mock LLM backend")
+    parser.add_argument("--scenarios", default=SCENARIOS_PATH)
+    parser.add_argument("--only", action="append", help="run only the named scenario (repeatable)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="print the changes against an earlier result file")
+    parser.add_argument("--repeat", type=int, default=1, help="run every scenario this many times")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per mock completion")
+    parser.add_argument("--record", metavar="RECORDING", help="use the real backend and save its completions")
+    parser.add_argument("--record-backend", default=None, help="backend to record from (default: LLM_BACKEND)")
+    parser.add_argument("--replay", metavar="RECORDING", help="answer from a recording instead of the script")
+    parser.add_argument("--async-planner", action="store_true")
+    parser.add_argument("--batch-classification", action="store_true")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--candidates", type=int, default=1)
+    parser.add_argument("--reuse-plans", action="store_true", help="allow reuse within a scenario's own run")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM response cache enabled")
+    parser.add_argument("--deadline", type=float, help="plan anytime with this many seconds per scenario")
+    parser.add_argument("--max-calls", type=int, help="plan anytime with this many LLM calls per scenario")
+    parser.add_argument("--max-tokens", type=int, help="plan anytime with this many LLM tokens per scenario")
+    parser.add_argument("--trace", metavar="TRACE", help="trace all calls and write them to this Chrome trace file")
+    args = parser.parse_args()
+    if args.streaming and args.batch_classification and not args.async_planner:
+        parser.error("--batch-classification cannot be combined with --streaming, except with --async-planner")
+    return args
+
+
+@contextmanager
+def logs_in(work_dir):
+    saved = [(module, name, getattr(module, name)) for module, name, _ in LOG_PATHS]
+    for module, name, path in LOG_PATHS:
+        setattr(module, name, os.path.join(work_dir, path))
+    try:
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+
+
+def main():
+    args = parse_args()
+    with open(args.scenarios) as scenarios_file:
+        scenarios = json.load(scenarios_file)["scenarios"]
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario["name"] in args.only]
+
+    recording = {}
+    if args.replay:
+        with open(args.replay) as recording_file:
+            recording = json.load(recording_file)
+
+    # Every call is counted and nothing is throttled; the scheduler itself still runs, as its cost is overhead
+    LLM_api.response_cache.enabled = args.cache
+    work_dir = tempfile.mkdtemp(prefix="htn-benchmark-")
+    LLM_api.scheduler.bucket = SharedTokenBucket(os.path.join(work_dir, "rate_limit.sqlite"), 10 ** 6, 1)
+    set_default_backend("benchmark")
+    if args.trace:
+        tracer.configure(1.0)
+
+    results = []
+    with logs_in(work_dir):
+        for scenario in scenarios:
+            for _ in range(args.repeat):
+                print(f"\n=== {scenario['name']} ===")
+                results.append(run_scenario(scenario, args, recording))
+
+    print("\nBenchmark results:")
+    for result in results:
+        print(f"  {result['scenario']:<24} success={result['success']!s:<5} calls={result['llm_calls']:<4} "
+              f"tokens={result['prompt_tokens']}+{result['completion_tokens']} wall={result['wall_time']:.3f}s "
+              f"overhead={result['planner_overhead']:.3f}s nodes={result['tree_size']}")
+        if result["unexpanded"]:
+            print(f"  {'':<24} {result['unexpanded']} tasks left unexpanded")
+        if result["unanswered_prompts"]:
+            print(f"  {'':<24} {result['unanswered_prompts']} prompts had no scripted answer")
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.record:
+        with open(args.record, "w") as recording_file:
+            json.dump(recording, recording_file, indent=1)
+        print(f"\nRecorded {len(recording)} completions to {args.record}")
+
+    if args.trace:
+        print(f"\nTrace of {tracer.write_chrome_trace(args.trace)} spans written to {args.trace}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "format": RESULT_FORMAT,
+                "version": RESULT_VERSION,
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "options": {name: value for name, value in vars(args).items()
+                            if name not in ("output", "compare", "scenarios")},
+                "results": results,
+            }, output_file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,176 @@
-import React, { useEffect, useState } from 'react';
+import React, { useCallback, useEffect, useMemo, useRef, useState } from 'react';
 import io from 'socket.io-client';
-import { Paper, Typography, List, ListItem, ListItemIcon, ListItemText, Collapse, IconButton } from '@mui/material';
+import { Paper, Typography, ListItem, ListItemIcon, ListItemText, IconButton } from '@mui/material';
 import { ArrowRight, ExpandLess, ExpandMore } from '@mui/icons-material';
 
+const emptyTree = { root: null, nodes: {} };
+
+// Rows have a fixed height so that the rows in view follow from the scroll position alone
+export const ROW_HEIGHT = 48;
+const OVERSCAN = 10;
+const DEFAULT_VIEWPORT_HEIGHT = 600;
+
+function snapshotToTree(snapshot) {
+  const nodes = {};
+  snapshot.nodes.forEach(node => {
+    nodes[node.node_name] = node;
+  });
+  return { root: snapshot.root, nodes };
+}
+
+// Patches only copy the nodes they touch, the rest of the map is shared with the previous state
+export function applyPatches(tree, patches) {
+  let root = tree.root;
+  const nodes = { ...tree.nodes };
+
+  patches.forEach(patch => {
+    switch (patch.op) {
+      case 'node-added': {
+        nodes[patch.node_name] = {
+          node_name: patch.node_name,
+          task_name: patch.task_name,
+          status: patch.status,
+          parent: patch.parent,
+          children: nodes[patch.node_name] ? nodes[patch.node_name].children : [],
+        };
+        const parent = nodes[patch.parent];
+        if (parent && !parent.children.includes(patch.node_name)) {
+          nodes[patch.parent] = { ...parent, children: [...parent.children, patch.node_name] };
+        }
+        if (!patch.parent) {
+          root = patch.node_name;
+        }
+        break;
+      }
+      case 'status-changed': {
+        const node = nodes[patch.node_name];
+        if (node) {
+          nodes[patch.node_name] = { ...node, status: patch.status };
+        }
+        break;
+      }
+      case 'node-removed': {
+        const node = nodes[patch.node_name];
+        if (!node) break;
+        const parent = nodes[node.parent];
+        if (parent) {
+          nodes[node.parent] = { ...parent, children: parent.children.filter(name => name !== patch.node_name) };
+        }
+        const stack = [patch.node_name];
+        while (stack.length) {
+          const removed = nodes[stack.pop()];
+          if (removed) {
+            delete nodes[removed.node_name];
+            stack.push(...removed.children);
+          }
+        }
+        if (root === patch.node_name) {
+          root = null;
+        }
+        break;
+      }
+      default:
+        break;
+    }
+  });
+
+  return { root, nodes };
+}
+
+// Depth-first list of the rows shown with the current expansion, built without recursion
+export function flattenVisibleRows(tree, expandedNodes) {
+  const rows = [];
+  const stack = tree.root ? [[tree.root, 0]] : [];
+  while (stack.length) {
+    const [nodeName, depth] = stack.pop();
+    const node = tree.nodes[nodeName];
+    if (!node) continue;
+    rows.push({ nodeName, depth });
+    if (expandedNodes[nodeName]) {
+      for (let index = node.children.length - 1; index >= 0; index--) {
+        stack.push([node.children[index], depth + 1]);
+      }
+    }
+  }
+  return rows;
+}
+
+const getStatusColor = (status) => {
+  switch (status) {
+    case "completed": return "green";
+    case "in-progress": return "blue";
+    case "failed": return "red";
+    case "unexpanded": return "orange";
+    default: return "grey";
+  }
+};
+
+// Patches replace only the node objects they touch, so a status change re-renders just that row
+const TaskRow = React.memo(function TaskRow({ node, depth, top, expanded, onToggle }) {
+  return (
+    <ListItem
+      component="div"
+      data-node-name={node.node_name}
+      style={{ position: 'absolute', top, left: 0, right: 0, height: ROW_HEIGHT, paddingLeft: 16 + depth * 20 }}
+    >
+      <ListItemIcon>
+        <ArrowRight style={{ color: getStatusColor(node.status) }} />
+      </ListItemIcon>
+      <ListItemText primary={`${node.task_name} (${node.status})`} />
+      {node.children.length > 0 && (
+        <IconButton edge="end" onClick={() => onToggle(node.node_name)}>
+          {expanded ? <ExpandLess /> : <ExpandMore />}
+        </IconButton>
+      )}
+    </ListItem>
+  );
+});
+
+// Mounts only the rows in view (plus a few above and below), whatever the size of the tree
+export function TaskTreeView({ tree, expandedNodes, onToggle }) {
+  const viewport = useRef(null);
+  const [scrollTop, setScrollTop] = useState(0);
+  const [viewportHeight, setViewportHeight] = useState(DEFAULT_VIEWPORT_HEIGHT);
+  const rows = useMemo(() => flattenVisibleRows(tree, expandedNodes), [tree, expandedNodes]);
+
+  useEffect(() => {
+    const measure = () => {
+      if (viewport.current && viewport.current.clientHeight) {
+        setViewportHeight(viewport.current.clientHeight);
+      }
+    };
+    measure();
+    window.addEventListener('resize', measure);
+    return () => window.removeEventListener('resize', measure);
+  }, []);
+
+  const first = Math.max(0, Math.floor(scrollTop / ROW_HEIGHT) - OVERSCAN);
+  const last = Math.min(rows.length, Math.ceil((scrollTop + viewportHeight) / ROW_HEIGHT) + OVERSCAN);
+
+  return (
+    <div
+      ref={viewport}
+      onScroll={(event) => setScrollTop(event.currentTarget.scrollTop)}
+      style={{ height: '75vh', overflowY: 'auto', position: 'relative' }}
+    >
+      <div style={{ height: rows.length * ROW_HEIGHT, position: 'relative' }}>
+        {rows.slice(first, last).map((row, index) => (
+          <TaskRow
+            key={row.nodeName}
+            node={tree.nodes[row.nodeName]}
+            depth={row.depth}
+            top={(first + index) * ROW_HEIGHT}
+            expanded={!!expandedNodes[row.nodeName]}
+            onToggle={onToggle}
+          />
+        ))}
+      </div>
+    </div>
+  );
+}
+
 function HTNPlanner() {
-  const [taskNode, setTaskNode] = useState(null);
+  const [tree, setTree] = useState(emptyTree);
   const [expandedNodes, setExpandedNodes] = useState({});
 
   useEffect(() => {
@@ -14,64 +180,44 @@ function HTNPlanner() {
       console.log('Socket connected');
     });
 
-    newSocket.on('task_node_update', (data) => {
-      console.log('Received task_node_update:', data);
-      setTaskNode(data);
-      setExpandedNodes(prev => ({ ...prev, [data.task_name]: true }));
+    newSocket.on('task_node_snapshot', (data) => {
+      setTree(snapshotToTree(data));
+      if (data.root) {
+        setExpandedNodes(prev => ({ ...prev, [data.root]: true }));
+      }
+    });
+
+    newSocket.on('task_node_patch', (data) => {
+      setTree(prev => applyPatches(prev, data.patches));
+      data.patches.forEach(patch => {
+        if (patch.op === 'node-added' && !patch.parent) {
+          setExpandedNodes(prev => ({ ...prev, [patch.node_name]: true }));
+        }
+      });
     });
 
     return () => newSocket.close();
   }, []);
 
-  const handleToggle = (node) => {
+  const handleToggle = useCallback((nodeName) => {
     setExpandedNodes(prev => ({
       ...prev,
-      [node.task_name]: !prev[node.task_name]
+      [nodeName]: !prev[nodeName]
     }));
-  };
-
-  const getStatusColor = (status) => {
-    switch (status) {
-      case "completed": return "green";
-      case "in-progress": return "blue";
-      case "failed": return "red";
-      default: return "grey";
-    }
-  };
-
-  const renderTaskNode = (node, depth = 0) => {
-    if (!node) return null;
-
-    return (
-      <List style={{ marginLeft: depth * 20 }}>
-        <ListItem>
-          <ListItemIcon>
-            <ArrowRight style={{ color: getStatusColor(node.status) }} />
-          </ListItemIcon>
-          <ListItemText primary={`${node.task_name} (${node.status})`} />
-          {node.children && node.children.length > 0 && (
-            <IconButton edge="end" onClick={() => handleToggle(node)}>
-              {expandedNodes[node.task_name] ? <ExpandLess /> : <ExpandMore />}
-            </IconButton>
-          )}
-        </ListItem>
-        <Collapse in={expandedNodes[node.task_name]} timeout="auto" unmountOnExit>
-          {node.children && node.children.map((child, index) => renderTaskNode(child, depth + 1))}
-        </Collapse>
-      </List>
-    );
-  };
+  }, []);
 
   return (
     <div style={{ display: 'flex', flexDirection: 'column', alignItems: 'center', marginTop: 20 }}>
       <Typography variant="h4" gutterBottom>
         HTN Planner Visualization
       </Typography>
-      <Paper style={{ width: '80%', padding: 20, overflow: 'auto', maxHeight: '80vh' }}>
-        {taskNode ? renderTaskNode(taskNode) : <Typography>Waiting for data...</Typography>}
+      <Paper style={{ width: '80%', padding: 20 }}>
+        {tree.root
+          ? <TaskTreeView tree={tree} expandedNodes={expandedNodes} onToggle={handleToggle} />
+          : <Typography>Waiting for data...</Typography>}
       </Paper>
     </div>
   );
 }
 
-export default HTNPlanner;
\ No newline at end of file
+export default HTNPlanner;
@@ -0,0 +1,93 @@
+import { render, fireEvent } from '@testing-library/react';
+import { TaskTreeView, applyPatches, flattenVisibleRows, ROW_HEIGHT } from './HTNPlanner';
+
+// Render benchmark for large plans; the timings are logged, the budget only catches a return to full rendering
+const RENDER_BUDGET_MS = 1000;
+
+function buildTree(size, branching = 4) {
+  const patches = [{ op: 'node-added', node_name: 't:0', task_name: 'goal', status: 'in-progress', parent: null }];
+  for (let id = 1; id < size; id++) {
+    patches.push({
+      op: 'node-added',
+      node_name: `t:${id}`,
+      task_name: `task ${id % 50}`,
+      status: 'pending',
+      parent: `t:${Math.floor((id - 1) / branching)}`,
+    });
+  }
+  return applyPatches({ root: null, nodes: {} }, patches);
+}
+
+function expandAll(tree) {
+  return Object.fromEntries(Object.keys(tree.nodes).map(nodeName => [nodeName, true]));
+}
+
+function timed(label, action) {
+  const start = performance.now();
+  const result = action();
+  const elapsed = performance.now() - start;
+  console.log(`${label}: ${elapsed.toFixed(1)}ms`);
+  return [result, elapsed];
+}
+
+describe.each([5000, 10000])('tree of %i nodes', (size) => {
+  const tree = buildTree(size);
+  const expanded = expandAll(tree);
+
+  test('flattens the expanded nodes depth first', () => {
+    const [rows] = timed(`flatten ${size} nodes`, () => flattenVisibleRows(tree, expanded));
+    expect(rows).toHaveLength(size);
+    expect(rows.slice(0, 3)).toEqual([
+      { nodeName: 't:0', depth: 0 },
+      { nodeName: 't:1', depth: 1 },
+      { nodeName: 't:5', depth: 2 },
+    ]);
+  });
+
+  test('mounts only the rows in view', () => {
+    const [{ container }, elapsed] = timed(`first render of ${size} nodes`, () =>
+      render(<TaskTreeView tree={tree} expandedNodes={expanded} onToggle={() => {}} />));
+    expect(container.querySelectorAll('[data-node-name]').length).toBeLessThan(50);
+    expect(elapsed).toBeLessThan(RENDER_BUDGET_MS);
+  });
+
+  test('renders the rows scrolled to', () => {
+    const { container } = render(<TaskTreeView tree={tree} expandedNodes={expanded} onToggle={() => {}} />);
+    const [, elapsed] = timed(`scroll to the end of ${size} nodes`, () =>
+      fireEvent.scroll(container.firstChild, { target: { scrollTop: (size - 10) * ROW_HEIGHT } }));
+
+    const lastRow = flattenVisibleRows(tree, expanded)[size - 1];
+    expect(container.querySelector(`[data-node-name="${lastRow.nodeName}"]`)).not.toBeNull();
+    expect(container.querySelector('[data-node-name="t:0"]')).toBeNull();
+    expect(elapsed).toBeLessThan(RENDER_BUDGET_MS);
+  });
+
+  test('applies a status change', () => {
+    const { container, rerender } = render(<TaskTreeView tree={tree} expandedNodes={expanded} onToggle={() => {}} />);
+    const updated = applyPatches(tree, [{ op: 'status-changed', node_name: 't:1', status: 'completed' }]);
+    const [, elapsed] = timed(`status change in ${size} nodes`, () =>
+      rerender(<TaskTreeView tree={updated} expandedNodes={expanded} onToggle={() => {}} />));
+
+    expect(container.querySelector('[data-node-name="t:1"]')).toHaveTextContent('(completed)');
+    expect(elapsed).toBeLessThan(RENDER_BUDGET_MS);
+  });
+});
+
+test('keeps the expansion of nodes with the same task name apart', () => {
+  const tree = applyPatches({ root: null, nodes: {} }, [
+    { op: 'node-added', node_name: 'd:0', task_name: 'goal', status: 'pending', parent: null },
+    { op: 'node-added', node_name: 'd:1', task_name: 'wash the cup', status: 'pending', parent: 'd:0' },
+    { op: 'node-added', node_name: 'd:2', task_name: 'wash the cup', status: 'pending', parent: 'd:0' },
+    { op: 'node-added', node_name: 'd:3', task_name: 'rinse the cup', status: 'pending', parent: 'd:1' },
+    { op: 'node-added', node_name: 'd:4', task_name: 'rinse the cup', status: 'pending', parent: 'd:2' },
+  ]);
+  const onToggle = jest.fn();
+  const { container } = render(
+    <TaskTreeView tree={tree} expandedNodes={{ 'd:0': true, 'd:1': true }} onToggle={onToggle} />);
+
+  expect(container.querySelector('[data-node-name="d:3"]')).not.toBeNull();
+  expect(container.querySelector('[data-node-name="d:4"]')).toBeNull();
+
+  fireEvent.click(container.querySelector('[data-node-name="d:2"] button'));
+  expect(onToggle).toHaveBeenCalledWith('d:2');
+});
@@ -2,38 +2,145 @@
 # Due to the expressiveness of language, a lot of steps that would generally require complex functions are left up
 # to the LLM
 
+import os
+import itertools
+import contextvars
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from LLM_utils import groq_is_goal, is_task_primitive, can_execute, log_state_change
-from LLM_api import call_groq_api, log_response
+from LLM_api import call_groq_api, log_response, response_cache
 from task_node import TaskNode
-from text_utils import extract_lists, trace_function_calls
+from tracing import trace_function_calls
+from metrics import measure_decompose
+from task_classifier import log_classifier_example
 from htn_prompts import *
 from vector_db import VectorDB
+from world_state import WorldState, parse_state_delta
+from prompt_budget import budget_sections
+from planning_budget import current_budget, BudgetExhausted
+
+# New decompositions requested for a task after all of its candidates failed, per task name and run
+REPAIR_ATTEMPTS = int(os.environ.get("PLAN_REPAIR_ATTEMPTS", 2))
 
 class HTNPlanner:
-    def __init__(self, goal_input, initial_state, goal_task, capabilities_input, max_depth=5, send_update_callback=None):
+    def __init__(self, goal_input, initial_state, goal_task, capabilities_input, max_depth=5, send_update_callback=None,
+                 reuse_plans=True, batch_classification=False, streaming=False, candidates=1, candidate_threshold=0.8,
+                 journal=None, db=None, repair_attempts=REPAIR_ATTEMPTS, budget=None):
         self.goal_input = goal_input
         self.initial_state = initial_state
         self.goal_task = goal_task
         self.capabilities_input = capabilities_input
         self.max_depth = max_depth
         self.send_update_callback = send_update_callback
+        self.reuse_plans = reuse_plans
+        self.batch_classification = batch_classification
+        self.streaming = streaming
+        self.candidates = candidates
+        self.candidate_threshold = candidate_threshold
+        self.journal = journal
+        # A plan library shared with other planners, as in service mode; otherwise each run opens its own
+        self.db = db
+        self.root_node = None
+        self.repair_attempts = repair_attempts
+        # Subtask lists that failed for each task, passed to the repair prompts so that they are not proposed again
+        self.failed_decompositions = defaultdict(list)
+        self.repairs = Counter()
+        # With a budget the run is an anytime search, see anytime_planning
+        self.budget = budget
+        self.expand_limit = None
+        if budget is not None and journal is not None:
+            raise ValueError("Budgeted planning cannot be journaled")
 
     def htn_planning(self):
-        db = VectorDB()
+        try:
+            if self.budget is not None:
+                return self.anytime_planning()
+            return self.plan_once()
+        finally:
+            # The decompositions stored during the run are written to disk in one go
+            (self.db or VectorDB.shared()).persist()
+
+    def anytime_planning(self):
+        # Iterative deepening under the budget: every pass plans the whole task one level deeper than the one before,
+        # leaving the tasks below the expansion limit unexpanded. The limit is separate from max_depth, so prompts
+        # do not change between passes and each pass replays the one before from the LLM response cache. When the
+        # budget runs out, the remaining tasks are left unexpanded and the best plan of all passes is returned
+        if not response_cache.enabled:
+            print("The LLM response cache is disabled, so every pass repeats the calls of the pass before")
+        token = current_budget.set(self.budget.start())
+        best = None
+        try:
+            for expand_limit in range(self.max_depth + 1):
+                self.expand_limit = expand_limit
+                # Every pass starts with the repair budgets of a fresh run, so that it asks for the same repair
+                # variants as the pass before and replays them from the cache
+                self.reset_repairs()
+                print(f"Anytime planning pass with expansion limit {expand_limit} ({self.budget.describe()})")
+                plan = self.plan_once()
+                if plan is not None and (best is None or completed_nodes(plan) >= completed_nodes(best)):
+                    best = plan
+                if plan is None or self.budget.exhausted() or not unexpanded_nodes(plan):
+                    break
+        finally:
+            current_budget.reset(token)
+            self.expand_limit = None
+
+        exhausted = self.budget.exhausted()
+        print(f"Anytime planning finished ({self.budget.describe()})" +
+              (f", out of {exhausted}" if exhausted else ""))
+        if best is not None:
+            if best is not self.root_node:
+                # The last pass may have been cut short by the budget; the frontend gets the plan that is returned
+                self.root_node = best
+                if self.send_update_callback:
+                    self.send_update_callback(best)
+            if unexpanded_nodes(best):
+                print(f"{unexpanded_nodes(best)} tasks of the plan are unexpanded")
+        return best
+
+    def reset_repairs(self):
+        self.failed_decompositions.clear()
+        self.repairs.clear()
+
+    def out_of_budget(self):
+        return self.budget is not None and self.budget.exhausted() is not None
+
+    def plan_once(self):
+        db = self.db or VectorDB.shared()
         root_node = TaskNode(self.goal_input)
+        send_update_callback = self.send_update_callback
         max_iterations = 100  # Adjust this value as needed
 
+        if self.journal:
+            if self.journal.resumed:
+                print(f"Resuming plan from {self.journal.path}")
+                root_node = self.journal.root
+            else:
+                self.journal.record_run(self.goal_input, self.initial_state, self.goal_task,
+                                        self.capabilities_input, self.max_depth)
+            send_update_callback = self.journal_updates(send_update_callback)
+            send_update_callback(root_node)
+
+        self.root_node = root_node
         print(f"Initial goal: {self.goal_task}")
-        success, _ = self.decompose(root_node, self.initial_state, 0, self.max_depth, 
-                                    self.capabilities_input, self.goal_task, db, self.send_update_callback)
+        success, _ = self.decompose(root_node, WorldState.from_text(self.initial_state), 0, self.max_depth, 
+                                    self.capabilities_input, self.goal_task, db, send_update_callback)
         
-        if success and root_node.status == "completed":
+        if success and root_node.status in ("completed", "unexpanded"):
             print("Plan found successfully!")
             return root_node
         else:
             print("Failed to find a valid plan.")
             return None
 
+    def journal_updates(self, send_update_callback):
+        def send_update(task_node):
+            self.journal.update(task_node)
+            if send_update_callback:
+                send_update_callback(task_node)
+        return send_update
+
     @trace_function_calls
     def htn_planning_recursive(self, state, goal_task, root_node, max_depth, capabilities_input, db, send_update_callback=None, task_history=None):
         if groq_is_goal(state, goal_task):
@@ -77,9 +184,10 @@ class HTNPlanner:
         return result == 'true'
 
     @trace_function_calls
+    @measure_decompose
     def decompose(self, task_node, state, depth, max_depth, capabilities_input, goal_state, db, send_update_callback=None, task_history=None):
         task = task_node.task_name
-        decompose_state = state
+        decompose_state = WorldState.from_text(state)
 
         print(f"Decomposing task (depth {depth}/{max_depth}): {task}")
 
@@ -90,64 +198,253 @@ class HTNPlanner:
                 send_update_callback(task_node)
             return False, decompose_state
 
-        subtasks_list = self.get_subtasks(task, decompose_state, max_depth - depth, capabilities_input, task_history)
-        print(f"Subtasks for {task}: {subtasks_list}")
+        if self.leave_unexpanded(task_node, depth, send_update_callback):
+            return True, decompose_state
+
+        try:
+            recorded = self.journal.subtasks.get(task_node.node_name) if self.journal else None
+            if recorded is not None:
+                # Resumed from the journal: the subtasks chosen before are decomposed again, reusing finished nodes
+                candidates = [recorded]
+            else:
+                candidates = self.subtask_candidates(task, decompose_state, max_depth - depth, capabilities_input, db,
+                                                     task_history)
+            # Once the candidates are used up, the task is repaired with new decompositions until its budget runs out.
+            # Only this subtree is redone: the siblings completed before it and their state changes are kept
+            repairs = iter(lambda: self.repair_subtasks(task, decompose_state, max_depth - depth, capabilities_input,
+                                                        task_history), None)
+            for attempt, subtasks in enumerate(itertools.chain(candidates, repairs)):
+                if attempt:
+                    # The failed attempt's subtree is dropped and the next one starts from the same state
+                    print(f"Falling back to the next decomposition for {task}")
+                    self.remove_children(task_node, send_update_callback)
+
+                success, updated_state = self.decompose_subtasks(task_node, subtasks, decompose_state, depth,
+                                                                 max_depth, capabilities_input, goal_state, db,
+                                                                 send_update_callback, task_history)
+                if success:
+                    if self.journal:
+                        self.journal.record_state(task_node, updated_state)
+                    task_node.status = "completed"
+                    if send_update_callback:
+                        send_update_callback(task_node)
+
+                    self.record_decomposition(task_node, state, capabilities_input, db)
+
+                    print(f"Task completed: {task}")
+                    return True, updated_state
+
+                # Streamed subtasks are only known up to the one that failed
+                self.record_failed_attempt(task, subtasks if isinstance(subtasks, list)
+                                           else [child.task_name for child in task_node.children])
+
+            if self.out_of_budget() and self.expand_limit is not None:
+                # The repairs it would have had are left to a later run, rather than failing the whole plan
+                self.remove_children(task_node, send_update_callback)
+                self.leave_unexpanded(task_node, depth, send_update_callback)
+                return True, decompose_state
 
-        if not subtasks_list:
-            print(f"No valid subtasks found for {task}")
             task_node.status = "failed"
             if send_update_callback:
                 send_update_callback(task_node)
             return False, decompose_state
+        except BudgetExhausted as e:
+            self.refused_by_budget(task_node, e, send_update_callback)
+            return True, decompose_state
+
+    def leave_unexpanded(self, task_node, depth, send_update_callback=None):
+        # Below the expansion limit of an anytime pass, or out of budget: the task is kept as it is, to be refined by
+        # a later pass or run, and the state is passed on unchanged
+        if self.expand_limit is None or (depth <= self.expand_limit and not self.out_of_budget()):
+            return False
+        print(f"Leaving task unexpanded: {task_node.task_name}")
+        task_node.status = "unexpanded"
+        if send_update_callback:
+            send_update_callback(task_node)
+        return True
+
+    def record_decomposition(self, task_node, state, capabilities_input, db):
+        # Stored for reuse, and logged as a negative example for the primitive check: the executed tasks are its
+        # positive ones
+        log_classifier_example("primitive", task_node.task_name, "", False)
+        db.add_task_node(task_node, state, capabilities_input)
+
+    def refused_by_budget(self, task_node, error, send_update_callback=None):
+        # An LLM call for the task was refused by the scheduler: the task is left unexpanded like the ones reached
+        # after the budget ran out, and whatever was built below it is dropped
+        print(f"{error}. Leaving task unexpanded: {task_node.task_name}")
+        self.remove_children(task_node, send_update_callback)
+        task_node.status = "unexpanded"
+        if send_update_callback:
+            send_update_callback(task_node)
 
-        task_node.status = "in-progress"
+    def repair_state(self):
+        # (failed decompositions, repairs made) per task, for the decomposition being run
+        return self.failed_decompositions, self.repairs
+
+    def record_failed_attempt(self, task, subtasks):
+        failed_decompositions, _ = self.repair_state()
+        if subtasks and subtasks not in failed_decompositions[task]:
+            failed_decompositions[task].append(list(subtasks))
+
+    def repair_subtasks(self, task, state, remaining_decompositions, capabilities_input, task_history=None):
+        # A new decomposition that avoids the failed ones, or None when the budget is spent or nothing new comes back
+        failed_decompositions, repairs = self.repair_state()
+        if repairs[task] >= self.repair_attempts or self.out_of_budget():
+            return None
+        repairs[task] += 1
+        failed_attempts = failed_decompositions[task]
+        print(f"Repairing {task} (attempt {repairs[task]}/{self.repair_attempts}), "
+              f"avoiding {len(failed_attempts)} failed decompositions")
+        # A variant of its own, so that a repair without failed attempts to list is still a new sample
+        subtasks = self.get_subtasks(task, state, remaining_decompositions, capabilities_input, task_history,
+                                     self.candidates + repairs[task], failed_attempts)
+        if not subtasks or subtasks in failed_attempts:
+            print(f"No new decomposition found for {task}")
+            return None
+        return subtasks
+
+    def remove_children(self, task_node, send_update_callback=None, start=0):
+        if len(task_node.children) <= start:
+            return
+        for child in task_node.children[start:]:
+            task_node.remove_child(child)
+            if self.journal:
+                self.journal.record_removal(child)
         if send_update_callback:
             send_update_callback(task_node)
 
-        for subtask in subtasks_list:
-            subtask_node = TaskNode(subtask, parent=task_node)
-            task_node.add_child(subtask_node)
-            
-            if is_task_primitive(subtask):
-                if can_execute(subtask, capabilities_input, decompose_state):
-                    print(f"Executing task: {subtask}")
-                    updated_state = self.execute_task(decompose_state, subtask)
-                    decompose_state = updated_state
-                    subtask_node.status = "completed"
-            else:
-                success, updated_state = self.decompose(subtask_node, decompose_state, depth + 1, max_depth,
-                                                capabilities_input, goal_state, db, send_update_callback, task_history)
-                if success:
-                    decompose_state = updated_state
+    def decompose_subtasks(self, task_node, subtasks, state, depth, max_depth, capabilities_input, goal_state, db,
+                           send_update_callback=None, task_history=None):
+        task = task_node.task_name
+        decompose_state = state
+
+        if isinstance(subtasks, list):
+            print(f"Subtasks for {task}: {subtasks}")
+            if self.journal:
+                self.journal.record_subtasks(task_node, subtasks)
+            verdicts = self.journaled_verdicts(task_node, subtasks)
+            if verdicts is None:
+                verdicts = self.classify_subtasks(subtasks, capabilities_input, decompose_state) if subtasks else []
+                if self.journal and any(verdicts):
+                    self.journal.record_classification(task_node, subtasks, verdicts)
+        else:
+            # Streamed subtasks are handled one by one while the rest of the list is still being generated
+            verdicts = itertools.repeat(None)
+
+        started = False
+        streamed = []
+        for index, (subtask, verdict) in enumerate(zip(subtasks, verdicts)):
+            streamed.append(subtask)
+            if not started:
+                started = True
+                task_node.status = "in-progress"
+                if send_update_callback:
+                    send_update_callback(task_node)
+
+            subtask_node = self.resumed_child(task_node, index, subtask)
+            if subtask_node is None:
+                subtask_node = TaskNode(subtask, parent=task_node)
+                task_node.add_child(subtask_node)
+            elif self.journal.recorded_state(subtask_node) is not None:
+                print(f"Already completed: {subtask}")
+                decompose_state = WorldState(self.journal.recorded_state(subtask_node))
+                continue
+            if send_update_callback:
+                send_update_callback(subtask_node)
+
+            try:
+                if self.out_of_budget():
+                    # Neither checked nor executed, and the state is passed on unchanged
+                    subtask_node.status = "unexpanded"
+                elif self.subtask_verdict(subtask_node, verdict, "primitive", lambda: is_task_primitive(subtask)):
+                    if self.subtask_verdict(subtask_node, verdict, "executable", lambda: can_execute(
+                            subtask, capabilities_input, decompose_state.relevant_to(subtask))):
+                        print(f"Executing task: {subtask}")
+                        updated_state = self.execute_task(decompose_state, subtask)
+                        decompose_state = updated_state
+                        if self.journal:
+                            self.journal.record_state(subtask_node, decompose_state)
+                        subtask_node.status = "completed"
                 else:
-                    subtask_node.status = "failed"
+                    success, updated_state = self.decompose(subtask_node, decompose_state, depth + 1, max_depth,
+                                                            capabilities_input, goal_state, db, send_update_callback,
+                                                            task_history)
+                    if success:
+                        decompose_state = updated_state
+                    else:
+                        subtask_node.status = "failed"
+            except BudgetExhausted as e:
+                # A check or state update the budget could not pay for; the state is passed on unchanged
+                self.refused_by_budget(subtask_node, e)
 
             if send_update_callback:
                 send_update_callback(subtask_node)
 
             if subtask_node.status == "failed":
-                task_node.status = "failed"
-                if send_update_callback:
-                    send_update_callback(task_node)
                 return False, decompose_state
 
-        task_node.status = "completed"
-        if send_update_callback:
-            send_update_callback(task_node)
+        if self.journal and not isinstance(subtasks, list):
+            self.remove_children(task_node, send_update_callback, len(streamed))
+            self.journal.record_subtasks(task_node, streamed)
 
-        if task_node.status == "completed":
-            db.add_task_node(task_node)
+        if not started:
+            print(f"No valid subtasks found for {task}")
+            return False, decompose_state
 
-        print(f"Task completed: {task}")
         return True, decompose_state
 
+    def subtask_verdict(self, subtask_node, verdict, check, ask):
+        # The batch verdict, else the journaled outcome of a run that was interrupted after the check, else ask().
+        # An asked outcome is journaled before the subtask is executed or decomposed
+        if verdict:
+            return verdict[check]
+        journaled = self.journal.verdicts.get(subtask_node.node_name, {}) if self.journal else {}
+        if check in journaled:
+            return journaled[check]
+        value = ask()
+        if self.journal:
+            self.journal.record_verdict(subtask_node, check, value)
+        return value
+
+    def journaled_verdicts(self, task_node, subtasks):
+        # The batch verdicts of a resumed decomposition, so that the batch classification is not sent again
+        entry = self.journal.classifications.get(task_node.node_name) if self.journal else None
+        return entry["verdicts"] if entry and entry["subtasks"] == subtasks else None
+
+    def resumed_child(self, task_node, index, subtask):
+        # The child created for this subtask before the run was interrupted, if any. Children of a stream that was
+        # cut off are kept as long as the new stream produces the same subtasks, the rest is dropped
+        if not self.journal or index >= len(task_node.children):
+            return None
+        if task_node.children[index].task_name == subtask:
+            return task_node.children[index]
+        self.remove_children(task_node, start=index)
+        return None
+
+    @trace_function_calls
+    def classify_subtasks(self, subtasks, capabilities_input, state):
+        # In batch mode all siblings are classified in one request, against the state the parent was entered with.
+        # Missing verdicts (None) fall back to is_task_primitive and can_execute
+        if not self.batch_classification:
+            return [None] * len(subtasks)
+        verdicts = classify_subtasks(subtasks, capabilities_input, state.relevant_to(" ".join(subtasks)))
+        log_response("classify_subtasks", verdicts)
+        for subtask, verdict in zip(subtasks, verdicts):
+            if verdict:
+                log_classifier_example("primitive", subtask, "", verdict["primitive"])
+                if verdict["primitive"]:
+                    log_classifier_example("executable", subtask, state, verdict["executable"], capabilities_input)
+        return verdicts
+
     @trace_function_calls
     def evaluate_candidate(self, task, subtasks, capabilities_input, task_history):
         max_retries = 3
         retries = 0
         while retries < max_retries:
-            # Max 10 token or 8 digits after the decimal 0.99999999
-            response = evaluate_candidate(self.goal_input, task, subtasks, capabilities_input, task_history)
+            # Max 10 token or 8 digits after the decimal 0.99999999. Every retry asks for a new sample, since the
+            # unparsable response is cached under the prompt
+            response = evaluate_candidate(self.goal_input, task, subtasks, capabilities_input, task_history, retries)
             try:
                 score = float(response.strip())
                 log_response("evaluate_candidate", score)
@@ -158,21 +455,110 @@ class HTNPlanner:
                     raise ValueError("Failed to convert response to float after multiple retries.")
 
 
+    def subtask_candidates(self, task, state, remaining_decompositions, capabilities_input, db, task_history=None):
+        # Subtask lists to try in order; there is more than one only in multi-candidate search
+        if self.reuse_plans:
+            # A stored decomposition of a similar task under the same capabilities, made in a similar state, saves the
+            # get_subtasks call
+            decomposition = db.find_decomposition(task, capabilities_input, state)
+            if decomposition and decomposition["subtasks"]:
+                return [[subtask["task"] for subtask in decomposition["subtasks"]]]
+        if self.candidates > 1:
+            return self.candidate_decompositions(task, state, remaining_decompositions, capabilities_input,
+                                                 task_history)
+        if self.streaming:
+            return [self.stream_subtasks(task, state, remaining_decompositions, capabilities_input, task_history)]
+        return [self.get_subtasks(task, state, remaining_decompositions, capabilities_input, task_history)]
+
+    def candidate_decompositions(self, task, state, remaining_decompositions, capabilities_input, task_history=None):
+        # Requests several decompositions at once and scores them as they arrive. The first one to reach the
+        # threshold ends the wait; the best scored one is tried first, then the rest, then any still outstanding
+        executor = ThreadPoolExecutor(max_workers=self.candidates)
+        # Each request runs in a copy of this context, which carries the planning budget it is charged to
+        futures = [executor.submit(contextvars.copy_context().run, self.get_subtasks, task, state,
+                                   remaining_decompositions, capabilities_input, task_history, variant)
+                   for variant in range(self.candidates)]
+        pending = set(futures)
+        scored = []
+        try:
+            for future in as_completed(futures):
+                pending.discard(future)
+                subtasks = self.candidate_result(future)
+                if not subtasks:
+                    continue
+                score = self.score_candidate(task, subtasks, capabilities_input, task_history)
+                print(f"Candidate decomposition for {task} scored {score}: {subtasks}")
+                scored.append((score, len(scored), subtasks))
+                if score >= self.candidate_threshold:
+                    break
+
+            scored.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+            for _, _, subtasks in scored:
+                yield subtasks
+
+            for future in as_completed(pending):
+                subtasks = self.candidate_result(future)
+                if subtasks:
+                    yield subtasks
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def candidate_result(self, future):
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Candidate decomposition failed: {e}")
+            return []
+
+    def score_candidate(self, task, subtasks, capabilities_input, task_history=None):
+        try:
+            return self.evaluate_candidate(task, subtasks, capabilities_input, task_history or [])
+        except ValueError as e:
+            print(f"Could not score candidate decomposition: {e}")
+            return 0.0
+
     @trace_function_calls
-    def get_subtasks(self, task, state, remaining_decompositions, capabilities_input, task_history=None):
-        subtasks_with_types = get_subtasks(task, state, remaining_decompositions, capabilities_input, task_history or [])
+    def get_subtasks(self, task, state, remaining_decompositions, capabilities_input, task_history=None, variant=0,
+                     failed_attempts=None):
+        relevant_state = WorldState.from_text(state).relevant_to(task)
+        subtasks_with_types = get_subtasks(task, relevant_state, remaining_decompositions, capabilities_input,
+                                           task_history or [], variant, failed_attempts)
         print(f"Decomposing task {task} into candidates:\n{subtasks_with_types}")
         return subtasks_with_types
 
 
+    def stream_subtasks(self, task, state, remaining_decompositions, capabilities_input, task_history=None):
+        relevant_state = WorldState.from_text(state).relevant_to(task)
+        for subtask in stream_subtasks(task, relevant_state, remaining_decompositions, capabilities_input,
+                                       task_history or []):
+            print(f"Streamed subtask for {task}: {subtask}")
+            yield subtask
+
     @trace_function_calls
     def execute_task(self, state, task):
-        prompt = (f"Given the current state '{state}' and the task '{task}', "
-                f"update the state after executing the task:")
-
-        response = call_groq_api(prompt)
-
-        updated_state = response.choices[0].message.content.strip()
+        # Only the facts about the task are sent, and only the facts that change come back
+        sections = budget_sections("execute_task", state=state.relevant_to(task))
+        prompt = (f"Given the current state facts '{sections['state']}' and the task '{task}', "
+                f"list the facts that change after executing the task. "
+                f"Provide ONLY a JSON object of the form "
+                f"{{\"add\": [new facts], \"delete\": [facts that no longer hold]}}, "
+                f"copying deleted facts exactly as given:")
+
+        response = call_groq_api(prompt, strip=True, call_site="execute_task")
+        delta = parse_state_delta(response)
+        if delta is None:
+            # Not a delta, so take it as a description of the new state of these facts
+            print(f"Error parsing state delta: {response}")
+            delta = list(WorldState.from_text(response)), list(state.relevant_to(task))
+        updated_state = state.apply(*delta)
         log_response("execute_task", task)
         log_state_change(state, updated_state, task)
         return updated_state
+
+
+def completed_nodes(plan):
+    return sum(1 for node, _ in plan.walk() if node.status == "completed")
+
+
+def unexpanded_nodes(plan):
+    return sum(1 for node, _ in plan.walk() if node.status == "unexpanded")
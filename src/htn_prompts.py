@@ -1,10 +1,23 @@
 import os
-from LLM_api import call_groq_api
+import json
+import queue
+import threading
+import contextvars
+from LLM_api import call_groq_api, stream_groq_api
+from llm_scheduler import CRITICAL
+from task_classifier import confident_verdict, log_classifier_example
+from prompt_budget import budget_sections
+from text_utils import IncrementalListParser, parse_list, log_parsing_errors
 
 def is_granular(task, capabilities_input):
+    verdict = confident_verdict("primitive", task)
+    if verdict is not None:
+        return verdict
+
     prompt = f"""Given the capabilities {capabilities_input}, is the task '{task}' granular enough to be directly executed or considered a primitive action by a robot? For instance, if a task includes the word scan, then it's granular because scanning can't be further broken down. Answer with "Yes" or "No"."""
     
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="is_granular")
+    log_classifier_example("primitive", task, "", response == "Yes")
     return response == "Yes"
 
 def translate(goal_input, original_task, capabilities_input):
@@ -14,43 +27,59 @@ def translate(goal_input, original_task, capabilities_input):
     
     When translated to use the specified capabilities the result is:"""
 
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="translate")
     return response
 
-def evaluate_candidate(goal_input, task, subtasks, capabilities_input, task_history):
+def evaluate_candidate(goal_input, task, subtasks, capabilities_input, task_history, variant=0):
+    sections = budget_sections("evaluate_candidate", capabilities=capabilities_input, history=task_history)
     prompt = f"""Given the parent goal {goal_input}, and the parent task {task}, and its subtasks {subtasks}, 
     evaluate how well these subtasks address the requirements 
     of the parent task without any gaps or redundancies, using the following capabilities: 
-    {capabilities_input}
+    {sections['capabilities']}
     Return a score between 0 and 1, where 1 is the best possible score.
     
     Consider the following task history to avoid repetition:
-    {', '.join(task_history)}
+    {sections['history']}
 
     Please follow this regex expression: ^[0]\.\d{{8}}$
     Provide only the score without any additional text.
     """
 
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="evaluate_candidate", variant=variant)
     return response
 
 def check_subtasks(task, subtasks, capabilities_input, task_history):
+    sections = budget_sections("check_subtasks", capabilities=capabilities_input, history=task_history)
     prompt = f"""Given the parent task '{task}', and its subtasks '{', '.join(subtasks)}',
     check if these subtasks effectively and comprehensively address the requirements
     of the parent task without any gaps or redundancies, using the following capabilities:
-    '{capabilities_input}'. Return 'True' if they meet the requirements or 'False' otherwise.
+    '{sections['capabilities']}'. Return 'True' if they meet the requirements or 'False' otherwise.
     
     Consider the following task history to avoid repetition:
-    {', '.join(task_history)}
+    {sections['history']}
     """
 
-    response = call_groq_api(prompt, strip=True)
+    response = call_groq_api(prompt, strip=True, call_site="check_subtasks")
     return response.lower() == 'true'
 
-def get_subtasks(task, state, remaining_decompositions, capabilities_input, task_history=None):
-    prompt = f"""Given the task '{task}', the current state '{state}',
+def get_subtasks(task, state, remaining_decompositions, capabilities_input, task_history=None, variant=0,
+                 failed_attempts=None):
+    # Each variant is a separate sample of the same prompt (and a separate cache entry)
+    prompt = subtasks_prompt(task, state, remaining_decompositions, capabilities_input, failed_attempts)
+    response = call_groq_api(prompt, strip=True, priority=CRITICAL, call_site="get_subtasks", variant=variant)
+    subtasks = parse_subtasks(response)
+    if subtasks is None:
+        # Only output that cannot be read at all is asked for again, in JSON mode
+        response = call_groq_api(json_subtasks_prompt(prompt), strip=True, priority=CRITICAL,
+                                 call_site="get_subtasks", variant=variant, json_mode=True)
+        subtasks = parse_subtasks(response)
+    return subtasks or []
+
+def subtasks_prompt(task, state, remaining_decompositions, capabilities_input, failed_attempts=None):
+    sections = budget_sections("get_subtasks", capabilities=capabilities_input, state=state)
+    prompt = f"""Given the task '{task}', the current state '{sections['state']}',
     {remaining_decompositions} decompositions remaining before failing,
-    and the following capabilities: '{capabilities_input}',
+    and the following capabilities: '{sections['capabilities']}',
     decompose the task into a detailed step-by-step plan.
     
     Provide ONLY the subtasks as a Python list of strings, without any additional text or explanations.
@@ -58,11 +87,95 @@ def get_subtasks(task, state, remaining_decompositions, capabilities_input, task
     and use primitive actions when possible (e.g., move, grab, clean, etc.).
     
     Example format: ['subtask1', 'subtask2', 'subtask3']"""
+    if failed_attempts:
+        # Only repairs list earlier attempts, so the prompt (and its cache entry) is otherwise unchanged
+        attempts = "\n    ".join(json.dumps(attempt) for attempt in failed_attempts)
+        prompt += f"""
 
-    response = call_groq_api(prompt, strip=True)
-    try:
-        subtasks = eval(response)
-        return subtasks if isinstance(subtasks, list) else []
-    except:
+    These decompositions of the task were already tried and failed, so provide a different one:
+    {attempts}"""
+    return prompt
+
+def json_subtasks_prompt(prompt):
+    return f"""{prompt}
+
+    Respond with ONLY a JSON object of the form {{"subtasks": ["subtask1", "subtask2", "subtask3"]}}."""
+
+def parse_subtasks(response):
+    # None when no list can be read from the response at all
+    subtasks = parse_list(response)
+    if subtasks is None:
         print(f"Error parsing subtasks: {response}")
-        return []
\ No newline at end of file
+        log_parsing_errors(response, [])
+    return subtasks
+
+def stream_subtasks(task, state, remaining_decompositions, capabilities_input, task_history=None):
+    # Yields each subtask as soon as the model has finished writing it. The stream is read on its own thread,
+    # so it keeps flowing while the caller works on the subtasks it already has
+    prompt = subtasks_prompt(task, state, remaining_decompositions, capabilities_input)
+    subtasks = queue.Queue()
+
+    def read_stream():
+        parser = IncrementalListParser()
+        response = []
+        try:
+            for chunk in stream_groq_api(prompt, priority=CRITICAL, call_site="get_subtasks"):
+                response.append(chunk)
+                for subtask in parser.feed(chunk):
+                    subtasks.put(subtask)
+            for subtask in parser.close():
+                subtasks.put(subtask)
+            if not parser.items:
+                for subtask in parse_subtasks("".join(response).strip()) or []:
+                    subtasks.put(subtask)
+        except Exception as e:
+            subtasks.put(e)
+        finally:
+            subtasks.put(None)
+
+    # Run in a copy of the caller's context, so that the stream is charged to the caller's planning budget
+    threading.Thread(target=contextvars.copy_context().run, args=(read_stream,), daemon=True).start()
+    while True:
+        subtask = subtasks.get()
+        if subtask is None:
+            return
+        if isinstance(subtask, Exception):
+            raise subtask
+        yield subtask
+
+def classify_subtasks(subtasks, capabilities_input, state):
+    numbered = "\n".join(f"{index + 1}. {subtask}" for index, subtask in enumerate(subtasks))
+    sections = budget_sections("classify_subtasks", capabilities=capabilities_input, state=state)
+    prompt = f"""Given the capabilities '{sections['capabilities']}' and the current state '{sections['state']}',
+    classify each of the following subtasks:
+    {numbered}
+
+    A subtask is primitive if a robot can perform it directly as a single action, and executable if it
+    can be executed with these capabilities in the current state.
+    Provide ONLY a JSON list with one object per subtask, in the same order, without any additional text:
+    [{{"subtask": "...", "primitive": true, "executable": true, "reason": "..."}}]"""
+
+    response = call_groq_api(prompt, strip=True, call_site="classify_subtasks")
+    return parse_verdicts(response, len(subtasks))
+
+def parse_verdicts(response, count):
+    # One verdict per subtask; entries that cannot be read are None so the caller can fall back to single checks
+    verdicts = [None] * count
+    try:
+        entries = json.loads(response[response.index("["):response.rindex("]") + 1])
+    except ValueError:
+        print(f"Error parsing subtask verdicts: {response}")
+        return verdicts
+
+    if not isinstance(entries, list):
+        return verdicts
+
+    for index, entry in enumerate(entries[:count]):
+        if (isinstance(entry, dict) and isinstance(entry.get("primitive"), bool)
+                and isinstance(entry.get("executable"), bool)):
+            verdicts[index] = {
+                "primitive": entry["primitive"],
+                "executable": entry["executable"],
+                "reason": str(entry.get("reason", "")),
+            }
+    return verdicts
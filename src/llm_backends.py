@@ -0,0 +1,244 @@
+# LLM backends and per-call-site model routing
+# Backends keep one long-lived client with a pooled HTTP connection; call sites are routed to the model and token
+# cap that suits them (small fast model with a tiny cap for yes/no checks, the large model for decomposition).
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import namedtuple
+
+import httpx
+
+from prompt_budget import count_tokens
+
+Completion = namedtuple("Completion", ["content", "prompt_tokens", "completion_tokens"])
+ModelRoute = namedtuple("ModelRoute", ["model", "max_tokens", "backend"], defaults=[None, None])
+
+MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 10))
+REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", 60))
+
+# LLM_BACKEND=openai points every call site at an OpenAI-compatible server (e.g. a local stand-in for Groq),
+# LLM_BACKEND=mock at the offline backend used by the benchmarks
+DEFAULT_BACKEND = os.environ.get("LLM_BACKEND", "groq")
+LOCAL_BASE_URL = os.environ.get("LLM_BASE_URL", "http://127.0.0.1:8000/v1")
+
+LARGE_MODEL = os.environ.get("LLM_LARGE_MODEL", "llama3-70b-8192")
+SMALL_MODEL = os.environ.get("LLM_SMALL_MODEL", "llama3-8b-8192")
+
+MODEL_ROUTES = {
+    "default": ModelRoute(LARGE_MODEL),
+    "get_subtasks": ModelRoute(LARGE_MODEL),
+    "execute_task": ModelRoute(LARGE_MODEL),
+    "translate": ModelRoute(LARGE_MODEL),
+    "get_initial_task": ModelRoute(LARGE_MODEL),
+    "compress_capabilities": ModelRoute(SMALL_MODEL),
+    "groq_is_goal": ModelRoute(SMALL_MODEL, 3),
+    "can_execute": ModelRoute(SMALL_MODEL, 3),
+    "is_granular": ModelRoute(SMALL_MODEL, 3),
+    "check_subtasks": ModelRoute(SMALL_MODEL, 3),
+    "evaluate_candidate": ModelRoute(SMALL_MODEL, 10),
+    "classify_subtasks": ModelRoute(SMALL_MODEL),
+}
+
+
+class LLMBackend:
+    name = None
+
+    def complete(self, messages, model, max_tokens=None, temperature=1.0, json_mode=False):
+        raise NotImplementedError
+
+    def stream(self, messages, model, max_tokens=None, temperature=1.0):
+        # Backends without streaming support yield the whole completion at once
+        yield self.complete(messages, model, max_tokens, temperature).content
+
+    def warm_up(self):
+        # Prepares the client ahead of the first call, without sending a request
+        pass
+
+
+class GroqBackend(LLMBackend):
+    name = "groq"
+
+    def __init__(self, api_key=None, max_connections=MAX_CONNECTIONS, timeout=REQUEST_TIMEOUT):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from groq import Groq
+
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_connections),
+                    timeout=self.timeout
+                )
+                self._client = Groq(api_key=self.api_key or os.environ.get("GROQ_API_KEY"), http_client=http_client)
+            return self._client
+
+    def warm_up(self):
+        # Imports groq and builds the client
+        self.client
+
+    def complete(self, messages, model, max_tokens=None, temperature=1.0, json_mode=False):
+        options = {"response_format": {"type": "json_object"}} if json_mode else {}
+        chat_completion = self.client.chat.completions.create(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **options
+        )
+        usage = chat_completion.usage
+        return Completion(chat_completion.choices[0].message.content,
+                          usage.prompt_tokens if usage else None,
+                          usage.completion_tokens if usage else None)
+
+    def stream(self, messages, model, max_tokens=None, temperature=1.0):
+        chunks = self.client.chat.completions.create(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, base_url=LOCAL_BASE_URL, api_key=None, max_connections=MAX_CONNECTIONS,
+                 timeout=REQUEST_TIMEOUT):
+        api_key = api_key or os.environ.get("LLM_API_KEY")
+        self.client = httpx.Client(
+            base_url=base_url.rstrip("/"),
+            headers={"Authorization": f"Bearer {api_key}"} if api_key else {},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout
+        )
+
+    def complete(self, messages, model, max_tokens=None, temperature=1.0, json_mode=False):
+        payload = {"model": model, "messages": messages, "temperature": temperature}
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+
+        response = self.client.post("/chat/completions", json=payload)
+        response.raise_for_status()
+        body = response.json()
+        usage = body.get("usage") or {}
+        return Completion(body["choices"][0]["message"]["content"],
+                          usage.get("prompt_tokens"), usage.get("completion_tokens"))
+
+    def stream(self, messages, model, max_tokens=None, temperature=1.0):
+        payload = {"model": model, "messages": messages, "temperature": temperature, "stream": True}
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+
+        with self.client.stream("POST", "/chat/completions", json=payload) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+
+
+def recording_key(messages, model, max_tokens=None, temperature=1.0):
+    payload = json.dumps([model, messages, max_tokens, temperature])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MockBackend(LLMBackend):
+    # Offline backend: completions come from a recording of earlier runs, then from responder(prompt).
+    # latency simulates the time a real request takes; token counts are estimated locally
+    name = "mock"
+
+    def __init__(self, responder=None, recording=None, latency=0.0):
+        self.responder = responder
+        self.recording = recording or {}
+        self.latency = latency
+        self.calls = 0
+        self.unanswered = 0
+        self._lock = threading.Lock()
+
+    def complete(self, messages, model, max_tokens=None, temperature=1.0, json_mode=False):
+        content = self.recording.get(recording_key(messages, model, max_tokens, temperature))
+        if content is None and self.responder is not None:
+            content = self.responder(messages[-1]["content"])
+        with self._lock:
+            self.calls += 1
+            if content is None:
+                self.unanswered += 1
+        if content is None:
+            content = ""
+        if self.latency:
+            time.sleep(self.latency)
+        return Completion(content, sum(count_tokens(message["content"]) for message in messages),
+                          count_tokens(content))
+
+
+class RecordingBackend(LLMBackend):
+    # Passes requests to another backend and keeps every completion, for replay through MockBackend
+    name = "recording"
+
+    def __init__(self, backend, recording=None):
+        self.backend = backend
+        self.recording = {} if recording is None else recording
+        self._lock = threading.Lock()
+
+    def complete(self, messages, model, max_tokens=None, temperature=1.0, json_mode=False):
+        completion = self.backend.complete(messages, model, max_tokens, temperature, json_mode)
+        with self._lock:
+            self.recording[recording_key(messages, model, max_tokens, temperature)] = completion.content
+        return completion
+
+
+backend_factories = {
+    "groq": GroqBackend,
+    "openai": OpenAICompatibleBackend,
+    "mock": MockBackend,
+}
+backends = {}
+backends_lock = threading.Lock()
+
+
+def register_backend(name, backend):
+    with backends_lock:
+        backends[name] = backend
+
+
+def get_backend(name=None):
+    name = name or DEFAULT_BACKEND
+    with backends_lock:
+        if name not in backends:
+            if name not in backend_factories:
+                raise ValueError(f"Unknown LLM backend: {name}")
+            backends[name] = backend_factories[name]()
+        return backends[name]
+
+
+def set_default_backend(name):
+    # For call sites whose route names no backend
+    global DEFAULT_BACKEND
+    DEFAULT_BACKEND = name
+
+
+def resolve_route(call_site):
+    route = MODEL_ROUTES.get(call_site, MODEL_ROUTES["default"])
+    return route._replace(backend=route.backend or DEFAULT_BACKEND)
@@ -0,0 +1,195 @@
+# Rate limiting and prioritisation of LLM requests
+# The token bucket lives in sqlite so that every planner process on the machine draws from the same quota.
+# Within a process, callers wait in a priority queue: critical-path calls are admitted before speculative
+# or housekeeping ones whenever the bucket is short of tokens.
+
+import os
+import time
+import heapq
+import random
+import sqlite3
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from planning_budget import current_budget
+
+CRITICAL = 0
+NORMAL = 10
+SPECULATIVE = 20
+HOUSEKEEPING = 30
+
+# Lowest priority the current context may issue calls at (e.g. everything inside a speculative branch)
+current_priority = contextvars.ContextVar("current_priority", default=CRITICAL)
+
+
+@contextmanager
+def priority(level):
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RetriesExhausted(Exception):
+    pass
+
+
+class SharedTokenBucket:
+    def __init__(self, path, calls, period, name="groq"):
+        self.path = path
+        self.rate = calls / period
+        self.capacity = calls
+        self.name = name
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            bucket_dir = os.path.dirname(self.path)
+            if bucket_dir and not os.path.exists(bucket_dir):
+                os.makedirs(bucket_dir)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, blocked_until REAL NOT NULL)"
+            )
+        return self._conn
+
+    def try_acquire(self):
+        # Returns 0 when a token was taken, otherwise the number of seconds to wait before trying again
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute("SELECT tokens, updated_at, blocked_until FROM buckets WHERE name = ?",
+                                   (self.name,)).fetchone()
+                tokens, updated_at, blocked_until = row if row else (self.capacity, now, 0.0)
+                tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+
+                if now < blocked_until:
+                    wait = blocked_until - now
+                elif tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / self.rate
+
+                conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at, blocked_until) "
+                             "VALUES (?, ?, ?, ?)", (self.name, tokens, now, blocked_until))
+                conn.execute("COMMIT")
+                return wait
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def block_until(self, until):
+        # Applies a provider-requested pause to every process sharing the bucket
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated_at, blocked_until FROM buckets WHERE name = ?",
+                               (self.name,)).fetchone()
+            tokens, updated_at, blocked_until = row if row else (self.capacity, now, 0.0)
+            conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at, blocked_until) "
+                         "VALUES (?, ?, ?, ?)", (self.name, tokens, updated_at, max(blocked_until, until)))
+            conn.execute("COMMIT")
+
+
+def is_rate_limited(error):
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status_code == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    def __init__(self, bucket, max_retries=3, base_delay=1.0, max_delay=60.0):
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, level):
+        entry = (level, next(self._sequence))
+        start = time.time()
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    if self._queue[0] != entry:
+                        self._condition.wait()
+                        continue
+                    # Only the head of the queue draws from the bucket, so nothing can overtake it
+                    wait = self.bucket.try_acquire()
+                    if wait <= 0:
+                        return time.time() - start
+                    self._condition.wait(wait)
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def submit(self, request, level=NORMAL, stats=None):
+        # stats, when given, receives the number of retries and the seconds spent waiting on the rate limit
+        level = max(level, current_priority.get())
+        stats = {} if stats is None else stats
+        stats.update(retries=0, rate_limit_wait=0.0)
+        last_error = None
+
+        # Calls on behalf of a budgeted plan are refused with BudgetExhausted once its budget is spent, both before
+        # queueing and after the wait for the rate limit, which may have used up its time
+        budget = current_budget.get()
+        if budget is not None:
+            budget.reserve()
+        called = False
+        try:
+            for attempt in range(self.max_retries):
+                stats["rate_limit_wait"] += self.acquire(level)
+                if budget is not None:
+                    budget.check(reserved=1)
+                called = True
+                try:
+                    return request()
+                except Exception as e:
+                    last_error = e
+                    stats["retries"] += 1
+                    if is_rate_limited(e):
+                        delay = retry_after(e)
+                        delay = self.backoff(attempt) if delay is None else delay + random.uniform(0, self.base_delay)
+                        self.bucket.block_until(time.time() + delay)
+                        print(f"Rate limited by provider: {e}. Retrying in {delay:.1f} seconds...")
+                    else:
+                        delay = self.backoff(attempt)
+                        print(f"Error encountered: {e}. Retrying in {delay:.1f} seconds...")
+                        time.sleep(delay)
+        finally:
+            if budget is not None:
+                budget.release(called)
+
+        raise RetriesExhausted(f"Failed to get a response after {self.max_retries} attempts: {last_error}")
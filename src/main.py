@@ -1,80 +1,152 @@
+import time
+
+START_TIME = time.perf_counter()
+
+import argparse
 import threading
 
-from flask import Flask
-from flask_cors import CORS
-from flask_socketio import SocketIO
 from htn_planner import HTNPlanner
+from async_htn_planner import AsyncHTNPlanner
 # from search_planner import SearchPlanner
 
 from LLM_utils import get_initial_task, compress_capabilities
-from text_utils import trace_function_calls
-
-app = Flask(__name__)
-CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-@trace_function_calls
-def task_node_to_dict(task_node):
-    if task_node is None:
-        return None
-
-    return {
-        "task_name": task_node.task_name,
-        "status": task_node.status,
-        "children": [task_node_to_dict(child) for child in task_node.children]
-    }
-
-@socketio.on('connect')
-def handle_connect():
-    print('Client connected')
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    print('Client disconnected')
-
-def send_task_node_update(task_node):
-    root_task_node = task_node
-    while root_task_node.parent is not None:
-        root_task_node = root_task_node.parent
-    task_node_data = task_node_to_dict(root_task_node)
-    socketio.emit('task_node_update', task_node_data)
-
-def task_node_to_dict(task_node):
-    return {
-        "task_name": task_node.task_name,
-        "status": task_node.status,
-        "children": [task_node_to_dict(child) for child in task_node.children]
-    }
-
-def run_server():
-    socketio.run(app, host="127.0.0.1", debug=True, use_reloader=False, port=5000, allow_unsafe_werkzeug=True, log_output=False)
-
-def print_plan(task_node, depth=0):
-    print(f"{'  ' * depth}- {task_node.task_name}")
-    for child in task_node.children:
-        print_plan(child, depth + 1)
+from LLM_api import response_cache
+from metrics import metrics, format_summary
+from plan_journal import PlanJournal
+from planning_budget import PlanningBudget
+from planning_service import PlanningService
+from tracing import tracer
+from warmup import Warmup, format_startup_report
+
+IMPORT_TIME = time.perf_counter() - START_TIME
+
+def print_plan(task_node):
+    for node, depth in task_node.walk():
+        print(f"{'  ' * depth}- {node.task_name}" + (" (unexpanded)" if node.status == "unexpanded" else ""))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="HTN planner backed by an LLM")
+    parser.add_argument("--async-planner", action="store_true",
+                        help="use the asyncio planner, which sends independent LLM calls concurrently")
+    parser.add_argument("--batch-classification", action="store_true",
+                        help="classify all sibling subtasks in a single LLM request")
+    parser.add_argument("--streaming", action="store_true",
+                        help="stream subtasks and start on each one as soon as it is generated")
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="request this many decompositions per task concurrently and commit to the best scored")
+    parser.add_argument("--resume", metavar="JOURNAL",
+                        help="continue the interrupted run recorded in this journal file")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as a planning service that takes jobs over HTTP and Socket.IO")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="number of plans the service runs at the same time")
+    parser.add_argument("--trace", type=float, nargs="?", const=1.0, metavar="RATE",
+                        help="record call spans for this fraction of root calls (default 1.0), see /trace")
+    parser.add_argument("--trace-output", default="traces/trace.json",
+                        help="file the Chrome trace is written to after planning")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS",
+                        help="plan anytime: refine the plan level by level and return the best one after this long")
+    parser.add_argument("--max-calls", type=int,
+                        help="plan anytime, returning the best plan once this many LLM calls are spent")
+    parser.add_argument("--max-tokens", type=int,
+                        help="plan anytime, returning the best plan once this many LLM tokens are spent")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="request new completions instead of reusing the cached responses of earlier runs")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false",
+                        help="load the lemmatizer, plan library, LLM clients and server on first use instead of "
+                             "in the background while the prompts wait for input")
+    args = parser.parse_args()
+    if args.resume and args.async_planner:
+        parser.error("--resume is only supported by the default planner")
+    if args.serve and args.resume:
+        parser.error("--resume cannot be combined with --serve")
+    if args.streaming and args.batch_classification and not args.async_planner:
+        # Streamed subtasks are started one by one, before their siblings are known
+        parser.error("--batch-classification cannot be combined with --streaming, except with --async-planner")
+    args.budget = PlanningBudget.from_options(args.deadline, args.max_calls, args.max_tokens)
+    if args.budget and args.resume:
+        parser.error("--resume cannot be combined with a planning budget")
+    return args
+
+def serve(args):
+    import server
+
+    server.planning_service = PlanningService(server.emit_task_update, workers=args.workers)
+    server.planning_service.start()
+    print("Serving planning jobs on http://127.0.0.1:5000/jobs")
+    server.run_server()
 
 def main():
-    initial_state = input("Describe the initial state: ")
-    goal = input("Describe your goal: ")
-    default_capabilities = "Manipulation actions (grab, push, pull, ...); Movement actions (move, reach, ...); Kitchen tasks (cook, bake, boil, ...); Cleaning tasks (clean, wipe, vacuum, ...); Miscellaneous tasks (scan, activate, identify, ...)"
-    print(f"Default capabilities: {default_capabilities}")
-    capabilities_input = input("Describe the capabilities available (press Enter to use default): ")
-    if not capabilities_input:
-        capabilities_input = default_capabilities
-
-    compressed_capabilities = compress_capabilities(capabilities_input)
-    goal_task = get_initial_task(goal)
-
-    print("\nUsing default HTN planner")
+    args = parse_args()
+    if args.trace is not None:
+        tracer.configure(args.trace)
+    if args.refresh_cache:
+        response_cache.refresh()
+    if args.serve:
+        serve(args)
+        return
+
+    warmup = Warmup().start() if args.warmup else None
+    prompt_start = time.perf_counter()
+    if args.resume:
+        # Everything the planner needs, including the LLM-derived goal task and capabilities, is in the journal
+        journal = PlanJournal(args.resume)
+        if journal.header is None:
+            print(f"{args.resume} is not a plan journal")
+            return
+        goal = journal.header["goal_input"]
+        initial_state = journal.header["initial_state"]
+        goal_task = journal.header["goal_task"]
+        compressed_capabilities = journal.header["capabilities_input"]
+        max_depth = journal.header["max_depth"]
+        print(f"Resuming goal: {goal}")
+        prompt_time = 0.0
+    else:
+        initial_state = input("Describe the initial state: ")
+        goal = input("Describe your goal: ")
+        default_capabilities = "Manipulation actions (grab, push, pull, ...); Movement actions (move, reach, ...); Kitchen tasks (cook, bake, boil, ...); Cleaning tasks (clean, wipe, vacuum, ...); Miscellaneous tasks (scan, activate, identify, ...)"
+        print(f"Default capabilities: {default_capabilities}")
+        capabilities_input = input("Describe the capabilities available (press Enter to use default): ")
+        prompt_time = time.perf_counter() - prompt_start
+        if not capabilities_input:
+            capabilities_input = default_capabilities
+
+        compressed_capabilities = compress_capabilities(capabilities_input)
+        goal_task = get_initial_task(goal)
+        max_depth = 5
+        # Anytime runs rebuild the tree on every pass, which the journal cannot follow
+        journal = None if args.async_planner or args.budget else PlanJournal.create()
+
+    if warmup:
+        warmup.wait()
+    import server
+
+    print()
+    print(format_startup_report(IMPORT_TIME, prompt_time, time.perf_counter() - START_TIME, warmup))
+
+    planner_class = AsyncHTNPlanner if args.async_planner else HTNPlanner
+    print("\nUsing async HTN planner" if args.async_planner else "\nUsing default HTN planner")
+    if journal:
+        print(f"Journaling this run to {journal.path}, continue it with --resume {journal.path}")
     print("Starting server...")
 
-    htn_planner = HTNPlanner(goal, initial_state, goal_task, compressed_capabilities, send_update_callback=send_task_node_update)
+    planner_options = {"journal": journal} if journal else {}
+    if args.budget:
+        planner_options["budget"] = args.budget
+    htn_planner = planner_class(goal, initial_state, goal_task, compressed_capabilities, max_depth=max_depth,
+                                send_update_callback=server.send_task_node_update,
+                                batch_classification=args.batch_classification, streaming=args.streaming,
+                                candidates=args.candidates, **planner_options)
     
-    server_thread = threading.Thread(target=run_server)
+    server_thread = threading.Thread(target=server.run_server)
     server_thread.start()
 
+    metrics_before = metrics.snapshot()
+    plan_start = time.perf_counter()
     plan = htn_planner.htn_planning()
+    plan_time = time.perf_counter() - plan_start
+    if journal:
+        journal.close()
 
     if plan:
         print("\nFinal plan:")
@@ -82,6 +154,16 @@ def main():
     else:
         print("\nNo valid plan found.")
 
+    print()
+    print(format_summary(metrics.summary_since(metrics_before), plan_time))
+
+    stats = response_cache.stats()
+    print(f"\nLLM cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+
+    if tracer.enabled:
+        spans = tracer.write_chrome_trace(args.trace_output)
+        print(f"Trace of {spans} spans written to {args.trace_output}")
+
     server_thread.join()
 
 if __name__ == '__main__':
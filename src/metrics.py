@@ -0,0 +1,161 @@
+# In-process metrics for LLM call sites and decomposition depths
+# Exposed in Prometheus text format by the Flask server and summarised per plan by main.py
+
+import time
+import inspect
+import threading
+import functools
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+COUNTERS = ("calls", "cache_hits", "retries", "prompt_tokens", "completion_tokens", "rate_limit_wait", "latency",
+            "prompt_tokens_saved")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.call_sites = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self.call_latency = defaultdict(Histogram)
+        self.decompose_latency = defaultdict(Histogram)
+
+    def record_llm_call(self, call_site, latency, prompt_tokens=0, completion_tokens=0, retries=0,
+                        rate_limit_wait=0.0, cache_hit=False):
+        with self._lock:
+            counters = self.call_sites[call_site]
+            counters["calls"] += 1
+            counters["cache_hits"] += int(cache_hit)
+            counters["retries"] += retries
+            counters["prompt_tokens"] += prompt_tokens or 0
+            counters["completion_tokens"] += completion_tokens or 0
+            counters["rate_limit_wait"] += rate_limit_wait
+            counters["latency"] += latency
+            self.call_latency[call_site].observe(latency)
+
+    def record_prompt_budget(self, call_site, original_tokens, budgeted_tokens):
+        with self._lock:
+            self.call_sites[call_site]["prompt_tokens_saved"] += original_tokens - budgeted_tokens
+
+    def record_decompose(self, depth, latency):
+        with self._lock:
+            self.decompose_latency[depth].observe(latency)
+
+    def snapshot(self):
+        with self._lock:
+            return {call_site: dict(counters) for call_site, counters in self.call_sites.items()}
+
+    def summary_since(self, snapshot):
+        current = self.snapshot()
+        summary = {}
+        for call_site, counters in current.items():
+            before = snapshot.get(call_site, dict.fromkeys(COUNTERS, 0))
+            delta = {name: counters[name] - before[name] for name in COUNTERS}
+            if delta["calls"]:
+                summary[call_site] = delta
+        return summary
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            counter_names = {
+                "calls": "llm_calls_total",
+                "cache_hits": "llm_cache_hits_total",
+                "retries": "llm_retries_total",
+                "prompt_tokens": "llm_prompt_tokens_total",
+                "completion_tokens": "llm_completion_tokens_total",
+                "rate_limit_wait": "llm_rate_limit_wait_seconds_total",
+                "prompt_tokens_saved": "llm_prompt_tokens_saved_total",
+            }
+            for counter, metric in counter_names.items():
+                lines.append(f"# TYPE {metric} counter")
+                for call_site, counters in sorted(self.call_sites.items()):
+                    lines.append(f'{metric}{{call_site="{call_site}"}} {counters[counter]}')
+
+            lines += render_histograms("llm_call_latency_seconds", "call_site", self.call_latency)
+            lines += render_histograms("decompose_latency_seconds", "depth", self.decompose_latency)
+        return "\n".join(lines) + "\n"
+
+
+def render_histograms(metric, label, histograms):
+    lines = [f"# TYPE {metric} histogram"]
+    for value, histogram in sorted(histograms.items()):
+        for bound, count in histogram.cumulative():
+            le = "+Inf" if bound == float("inf") else bound
+            lines.append(f'{metric}_bucket{{{label}="{value}",le="{le}"}} {count}')
+        lines.append(f'{metric}_sum{{{label}="{value}"}} {histogram.sum}')
+        lines.append(f'{metric}_count{{{label}="{value}"}} {histogram.count}')
+    return lines
+
+
+def format_summary(summary, wall_time=None):
+    lines = ["LLM calls per call site:"]
+    total = dict.fromkeys(COUNTERS, 0)
+    for call_site, counters in sorted(summary.items()):
+        for name in COUNTERS:
+            total[name] += counters[name]
+        lines.append(f"  {call_site:<22} calls={counters['calls']:<4} cache_hits={counters['cache_hits']:<4} "
+                     f"tokens={counters['prompt_tokens']}+{counters['completion_tokens']} "
+                     f"retries={counters['retries']} latency={counters['latency']:.1f}s "
+                     f"rate_limit_wait={counters['rate_limit_wait']:.1f}s "
+                     f"tokens_saved={counters['prompt_tokens_saved']}")
+    lines.append(f"  {'total':<22} calls={total['calls']:<4} cache_hits={total['cache_hits']:<4} "
+                 f"tokens={total['prompt_tokens']}+{total['completion_tokens']} "
+                 f"retries={total['retries']} latency={total['latency']:.1f}s "
+                 f"rate_limit_wait={total['rate_limit_wait']:.1f}s "
+                 f"tokens_saved={total['prompt_tokens_saved']}")
+    if wall_time is not None:
+        lines.append(f"  wall time {wall_time:.1f}s, "
+                     f"of which {total['rate_limit_wait']:.1f}s waiting on the rate limit")
+    return "\n".join(lines)
+
+
+def measure_decompose(func):
+    # Records the latency of each decompose call by depth, for plain and async planners alike
+    depth_index = list(inspect.signature(func).parameters).index("depth")
+
+    def depth_of(args, kwargs):
+        return kwargs["depth"] if "depth" in kwargs else args[depth_index]
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.record_decompose(depth_of(args, kwargs), time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.record_decompose(depth_of(args, kwargs), time.perf_counter() - start)
+    return wrapper
+
+
+metrics = MetricsRegistry()
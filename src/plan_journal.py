@@ -0,0 +1,156 @@
+# Append-only journal of a planning run
+# Every node creation, status change, chosen subtask list, subtask check, removal and state transition is written
+# as one JSON line
+# and fsynced before planning moves on. Opening an existing journal replays it into a TaskNode tree with the same
+# node names, so that a crashed or interrupted run can continue without repeating the LLM calls it already made.
+
+import os
+import json
+import time
+import uuid
+import threading
+
+from task_node import TaskNode, TaskTree
+
+JOURNAL_DIR = os.environ.get("PLAN_JOURNAL_DIR", "journals")
+
+
+class PlanJournal:
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.root = None
+        self.tree = None
+        self.nodes = {}
+        self.subtasks = {}
+        self.states = {}
+        self.verdicts = {}
+        self.classifications = {}
+        self._statuses = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            self._load()
+        else:
+            journal_dir = os.path.dirname(path)
+            if journal_dir and not os.path.exists(journal_dir):
+                os.makedirs(journal_dir)
+        self._file = open(path, "a")
+
+    @classmethod
+    def create(cls, directory=JOURNAL_DIR):
+        # Unique per run, also for the concurrent runs of service mode
+        return cls(os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl"))
+
+    @property
+    def resumed(self):
+        return self.root is not None
+
+    def _load(self):
+        with open(self.path, "rb") as journal_file:
+            data = journal_file.read()
+
+        # A crash in the middle of a write leaves a partial last line, which is cut off before appending
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            print(f"Discarding incomplete last entry of {self.path}")
+            with open(self.path, "r+b") as journal_file:
+                journal_file.truncate(end)
+
+        for line in data[:end].decode("utf-8").splitlines():
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError) as e:
+                print(f"Skipping unreadable journal entry: {e}")
+
+    def _apply(self, entry):
+        event = entry["event"]
+        if event == "run":
+            self.header = entry
+        elif event == "node":
+            node = self.nodes.get(entry["node"])
+            if node is None:
+                # Rebuilt under the same tree uid and ids, so node names stay the same
+                uid, node_id = entry["node"].rsplit(":", 1)
+                if self.tree is None:
+                    self.tree = TaskTree(uid)
+                node = TaskNode(entry["task"], status=entry["status"], tree=self.tree, node_id=int(node_id))
+                self.nodes[node.node_name] = node
+                parent = self.nodes.get(entry["parent"])
+                if parent is not None:
+                    parent.add_child(node)
+                elif entry["parent"] is None:
+                    self.root = node
+            node.status = entry["status"]
+            self._statuses[node.node_name] = node.status
+        elif event == "status":
+            self.nodes[entry["node"]].status = entry["status"]
+            self._statuses[entry["node"]] = entry["status"]
+        elif event == "subtasks":
+            self.subtasks[entry["node"]] = entry["subtasks"]
+        elif event == "state":
+            self.states[entry["node"]] = entry["facts"]
+        elif event == "verdict":
+            self.verdicts.setdefault(entry["node"], {})[entry["check"]] = entry["value"]
+        elif event == "classification":
+            self.classifications[entry["node"]] = entry
+        elif event == "remove":
+            node = self.nodes.get(entry["node"])
+            if node is not None and node.parent is not None:
+                node.parent.remove_child(node)
+
+    def _write(self, event, fields):
+        self._file.write(json.dumps(dict(event=event, time=time.time(), **fields)) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, event, **fields):
+        with self._lock:
+            self._write(event, fields)
+
+    def record_run(self, goal_input, initial_state, goal_task, capabilities_input, max_depth):
+        self.record("run", goal_input=goal_input, initial_state=str(initial_state), goal_task=goal_task,
+                    capabilities_input=capabilities_input, max_depth=max_depth)
+
+    def record_subtasks(self, task_node, subtasks):
+        self.record("subtasks", node=task_node.node_name, subtasks=list(subtasks))
+
+    def record_state(self, task_node, state):
+        # The state right after the node completed, as a sorted list of facts
+        self.record("state", node=task_node.node_name, facts=list(state))
+
+    def record_verdict(self, task_node, check, value):
+        # The outcome of the primitive or executable check of a subtask, so that a resumed run does not repeat it
+        self.verdicts.setdefault(task_node.node_name, {})[check] = value
+        self.record("verdict", node=task_node.node_name, check=check, value=value)
+
+    def record_classification(self, task_node, subtasks, verdicts):
+        # The batch verdicts for the subtasks of a node, as one entry, since they come from one request
+        entry = {"node": task_node.node_name, "subtasks": subtasks, "verdicts": verdicts}
+        self.classifications[task_node.node_name] = entry
+        self.record("classification", **entry)
+
+    def record_removal(self, task_node):
+        self.record("remove", node=task_node.node_name)
+
+    def update(self, task_node):
+        # Called with every node update sent to the frontend; only new nodes and changed statuses are written
+        with self._lock:
+            status = self._statuses.get(task_node.node_name)
+            if status is None:
+                parent = task_node.parent.node_name if task_node.parent is not None else None
+                self._write("node", {"node": task_node.node_name, "parent": parent, "task": task_node.task_name,
+                                     "status": task_node.status})
+            elif status != task_node.status:
+                self._write("status", {"node": task_node.node_name, "status": task_node.status})
+            self._statuses[task_node.node_name] = task_node.status
+
+    def recorded_state(self, task_node):
+        facts = self.states.get(task_node.node_name)
+        if facts is None or task_node.status != "completed":
+            return None
+        return facts
+
+    def close(self):
+        with self._lock:
+            self._file.close()
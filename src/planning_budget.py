@@ -0,0 +1,90 @@
+# Budgets for anytime planning
+# A PlanningBudget bounds a planning run by wall-clock time, LLM calls and tokens. Completions are charged to the
+# budget of the run that requested them through a context variable, so that the concurrent jobs of service mode are
+# accounted separately. Cache hits and requests coalesced with one already in flight are free.
+# The scheduler reserves a call before every request and refuses it with BudgetExhausted once the budget is spent,
+# so that concurrent calls (the async planner's siblings and speculations) cannot overshoot the call limit.
+
+import time
+import threading
+import contextvars
+
+current_budget = contextvars.ContextVar("current_budget", default=None)
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class PlanningBudget:
+    def __init__(self, time_limit=None, max_calls=None, max_tokens=None):
+        self.time_limit = time_limit
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.calls = 0
+        self.tokens = 0
+        # Calls admitted by the scheduler that have not finished yet
+        self.pending = 0
+        self.started = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, time_limit=None, max_calls=None, max_tokens=None):
+        # None when no limit is given at all
+        if time_limit is None and max_calls is None and max_tokens is None:
+            return None
+        return cls(time_limit, max_calls, max_tokens)
+
+    def start(self):
+        if self.started is None:
+            self.started = time.monotonic()
+        return self
+
+    def elapsed(self):
+        return time.monotonic() - self.started if self.started is not None else 0.0
+
+    def reserve(self):
+        with self._lock:
+            self.check()
+            self.pending += 1
+
+    def release(self, called=True):
+        # called is False when the reserved call was refused or never sent
+        with self._lock:
+            self.pending -= 1
+            if called:
+                self.calls += 1
+
+    def charge(self, prompt_tokens=0, completion_tokens=0):
+        with self._lock:
+            self.tokens += (prompt_tokens or 0) + (completion_tokens or 0)
+
+    def check(self, reserved=0):
+        exhausted = self.exhausted(reserved)
+        if exhausted:
+            raise BudgetExhausted(f"Planning budget exhausted ({exhausted}): {self.describe()}")
+
+    def exhausted(self, reserved=0):
+        # The limit that has been reached, or None. Calls in flight count against the call limit, except for the
+        # reserved ones of the caller itself
+        if self.time_limit is not None and self.elapsed() >= self.time_limit:
+            return "time"
+        if self.max_calls is not None and self.calls + self.pending - reserved >= self.max_calls:
+            return "calls"
+        if self.max_tokens is not None and self.tokens >= self.max_tokens:
+            return "tokens"
+        return None
+
+    def describe(self):
+        limits = [
+            f"{self.elapsed():.1f}s" + (f" of {self.time_limit:g}s" if self.time_limit is not None else ""),
+            f"{self.calls} calls" + (f" of {self.max_calls}" if self.max_calls is not None else ""),
+            f"{self.tokens} tokens" + (f" of {self.max_tokens}" if self.max_tokens is not None else ""),
+        ]
+        return ", ".join(limits)
+
+
+def charge_budget(prompt_tokens=0, completion_tokens=0):
+    budget = current_budget.get()
+    if budget is not None:
+        budget.charge(prompt_tokens, completion_tokens)
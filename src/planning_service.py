@@ -0,0 +1,176 @@
+# Planning jobs for service mode
+# Jobs are queued and run by a fixed pool of worker threads. All workers share the LLM scheduler, the response cache
+# and the plan library; each job streams its task tree to its own Socket.IO room and writes its own journal.
+
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+
+from htn_planner import HTNPlanner
+from async_htn_planner import AsyncHTNPlanner
+from LLM_utils import get_initial_task, compress_capabilities
+from plan_journal import PlanJournal
+from planning_budget import PlanningBudget
+from task_updates import TaskNodeStream
+from vector_db import VectorDB
+
+DEFAULT_CAPABILITIES = "Manipulation actions (grab, push, pull, ...); Movement actions (move, reach, ...); Kitchen tasks (cook, bake, boil, ...); Cleaning tasks (clean, wipe, vacuum, ...); Miscellaneous tasks (scan, activate, identify, ...)"
+JOB_STATUS_EVENT = "job_status"
+MAX_QUEUED_JOBS = 100
+MAX_FINISHED_JOBS = 500
+MAX_DEPTH_LIMIT = 8
+# Each candidate is a concurrent request on a thread of its own
+MAX_CANDIDATES = 5
+
+
+class PlanningJob:
+    def __init__(self, request, emit):
+        self.job_id = uuid.uuid4().hex
+        self.room = f"job:{self.job_id}"
+        self.initial_state = request["initial_state"]
+        self.goal = request["goal"]
+        self.capabilities = request.get("capabilities") or DEFAULT_CAPABILITIES
+        self.max_depth = min(max(int(request.get("max_depth", 5)), 0), MAX_DEPTH_LIMIT)
+        self.options = {
+            "batch_classification": bool(request.get("batch_classification", False)),
+            "streaming": bool(request.get("streaming", False)),
+            "candidates": min(max(int(request.get("candidates", 1)), 1), MAX_CANDIDATES),
+        }
+        # Callers with a latency target set a deadline (seconds) or call and token limits, and get the best plan
+        # found within them; budgeted jobs are not journaled
+        budget = PlanningBudget.from_options(
+            float(request["deadline"]) if request.get("deadline") is not None else None,
+            int(request["max_calls"]) if request.get("max_calls") is not None else None,
+            int(request["max_tokens"]) if request.get("max_tokens") is not None else None)
+        if budget:
+            self.options["budget"] = budget
+        self.async_planner = bool(request.get("async_planner", False))
+        if self.options["streaming"] and self.options["batch_classification"] and not self.async_planner:
+            raise ValueError("batch_classification cannot be combined with streaming, except with async_planner")
+        self.status = "queued"
+        self.error = None
+        self.plan = None
+        self.journal_path = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.emit = emit
+        # Every event of this job goes to its room only and carries the job id
+        self.stream = TaskNodeStream(lambda event, data, to=None: emit(event, dict(data, job_id=self.job_id),
+                                                                       to=to or self.room))
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed")
+
+    def set_status(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.emit(JOB_STATUS_EVENT, self.to_dict(), to=self.room)
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "room": self.room,
+            "status": self.status,
+            "goal": self.goal,
+            "error": self.error,
+            "journal": self.journal_path,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "budget": self.options["budget"].describe() if "budget" in self.options else None,
+        }
+
+
+class PlanningService:
+    def __init__(self, emit, workers=2, max_queued=MAX_QUEUED_JOBS, max_finished=MAX_FINISHED_JOBS):
+        # emit(event, data, to=None) is the Socket.IO emit of the server
+        self.emit = emit
+        self.workers = workers
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._db = None
+
+    def start(self):
+        # One plan library for all workers, so that a decomposition stored by one job is found by the next
+        self._db = VectorDB.shared()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"planner-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"Planning service started with {self.workers} workers")
+
+    def submit(self, request):
+        # Raises KeyError or ValueError for an invalid request and queue.Full when too many jobs are waiting
+        job = PlanningJob(request, self.emit)
+        if not str(job.initial_state).strip() or not str(job.goal).strip():
+            raise ValueError("initial_state and goal must not be empty")
+        with self._lock:
+            self._queue.put_nowait(job)
+            self.jobs[job.job_id] = job
+            self._prune()
+        print(f"Queued job {job.job_id}: {job.goal}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"Job {job.job_id} failed: {e}")
+                job.finished_at = time.time()
+                job.set_status("failed", str(e))
+            finally:
+                job.stream.flush()
+                self._queue.task_done()
+
+    def _run(self, job):
+        job.started_at = time.time()
+        job.set_status("running")
+
+        capabilities = compress_capabilities(job.capabilities)
+        goal_task = get_initial_task(job.goal)
+
+        if job.async_planner:
+            planner = AsyncHTNPlanner(job.goal, job.initial_state, goal_task, capabilities, job.max_depth,
+                                      send_update_callback=job.stream.update, db=self._db, **job.options)
+        else:
+            journal = None if "budget" in job.options else PlanJournal.create()
+            job.journal_path = journal.path if journal else None
+            planner = HTNPlanner(job.goal, job.initial_state, goal_task, capabilities, job.max_depth,
+                                 send_update_callback=job.stream.update, journal=journal, db=self._db,
+                                 **job.options)
+        try:
+            job.plan = planner.htn_planning()
+        finally:
+            if planner.journal:
+                planner.journal.close()
+
+        job.finished_at = time.time()
+        if job.plan:
+            job.set_status("completed")
+        else:
+            job.set_status("failed", "No valid plan found")
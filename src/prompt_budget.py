@@ -0,0 +1,111 @@
+# Token budgets for the variable sections of prompts
+# Capabilities, state and task history are counted locally and compressed per call site before a prompt is
+# assembled: duplicates are dropped, recent history is kept and older history is summarised into one line.
+
+import re
+
+from metrics import metrics
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+ITEM_SEPARATORS = re.compile(r"\s*(?:;|\n)\s*")
+
+PROMPT_BUDGETS = {
+    "default": {"capabilities": 300, "state": 400, "history": 200},
+    "get_subtasks": {"capabilities": 300, "state": 400, "history": 200},
+    "classify_subtasks": {"capabilities": 200, "state": 300},
+    "can_execute": {"capabilities": 200, "state": 200},
+    "groq_is_goal": {"state": 600},
+    "execute_task": {"state": 300},
+    "evaluate_candidate": {"capabilities": 200, "history": 200},
+    "check_subtasks": {"capabilities": 200, "history": 200},
+}
+
+
+def count_tokens(text):
+    # Close to BPE counts for English: one token per word or symbol, plus one per further 6 characters of a word
+    return sum(1 + (len(token) - 1) // 6 for token in TOKEN_PATTERN.findall(str(text)))
+
+
+def deduplicate(items):
+    seen = set()
+    unique = []
+    for item in items:
+        key = " ".join(str(item).lower().split())
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(str(item).strip())
+    return unique
+
+
+def summarize_history(items):
+    verbs = deduplicate(item.split()[0] for item in items if item.split())
+    return f"{len(items)} earlier steps ({', '.join(verbs[:5])}{', ...' if len(verbs) > 5 else ''})"
+
+
+def fit_history(items, budget):
+    # Most recent items are kept; everything older collapses into a summary line
+    items = deduplicate(reversed(list(items)))[::-1]
+    kept = []
+    used = 0
+    for item in reversed(items):
+        cost = count_tokens(item) + 1
+        if used + cost > budget:
+            break
+        kept.insert(0, item)
+        used += cost
+
+    older = items[:len(items) - len(kept)]
+    if older:
+        summary = summarize_history(older)
+        while kept and used + count_tokens(summary) > budget:
+            used -= count_tokens(kept[0]) + 1
+            older.append(kept.pop(0))
+            summary = summarize_history(older)
+        kept.insert(0, summary)
+    return ", ".join(kept)
+
+
+def fit_items(items, budget, separator="; "):
+    # Items are kept in order until the budget is spent; the rest is counted
+    items = deduplicate(items)
+    kept = []
+    used = 0
+    for item in items:
+        cost = count_tokens(item) + 1
+        if used + cost > budget:
+            break
+        kept.append(item)
+        used += cost
+
+    omitted = len(items) - len(kept)
+    if omitted:
+        kept.append(f"({omitted} more omitted)")
+    return separator.join(kept)
+
+
+def fit_section(name, value, budget):
+    if name == "history":
+        return fit_history(value or [], budget)
+    if name == "state":
+        # WorldState iterates over its facts, free text is split into sentences
+        items = list(value) if not isinstance(value, str) else ITEM_SEPARATORS.split(value.replace(". ", "; "))
+        return fit_items(items, budget)
+    return fit_items(ITEM_SEPARATORS.split(str(value)), budget)
+
+
+def budget_sections(call_site, **sections):
+    budgets = PROMPT_BUDGETS.get(call_site, PROMPT_BUDGETS["default"])
+    fitted = {}
+    original_tokens = budgeted_tokens = 0
+    for name, value in sections.items():
+        original = ", ".join(map(str, value)) if name == "history" else str(value)
+        budget = budgets.get(name)
+        if budget is None or count_tokens(original) <= budget:
+            fitted[name] = original
+        else:
+            fitted[name] = fit_section(name, value, budget)
+        original_tokens += count_tokens(original)
+        budgeted_tokens += count_tokens(fitted[name])
+
+    metrics.record_prompt_budget(call_site, original_tokens, budgeted_tokens)
+    return fitted
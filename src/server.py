@@ -0,0 +1,131 @@
+# Web server of the planner
+# The Flask app with the metrics, trace and job endpoints and the Socket.IO events that stream task trees to the
+# frontend. Imported by main.py only once the server is needed (or by the warm-up), as flask_socketio is slow to load.
+
+import queue
+
+from flask import Flask, Response, request, jsonify
+from flask_cors import CORS
+from flask_socketio import SocketIO, join_room, leave_room
+from LLM_api import response_cache
+from metrics import metrics
+from task_updates import TaskNodeStream
+from tracing import tracer
+
+app = Flask(__name__)
+CORS(app)
+socketio = SocketIO(app, cors_allowed_origins="*")
+
+def task_node_to_dict(task_node):
+    if task_node is None:
+        return None
+    return task_node.to_dict()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    cache_stats = response_cache.stats()
+    cache_lines = [
+        "# TYPE llm_response_cache_hits_total counter",
+        f"llm_response_cache_hits_total {cache_stats['hits']}",
+        "# TYPE llm_response_cache_misses_total counter",
+        f"llm_response_cache_misses_total {cache_stats['misses']}",
+        "# TYPE llm_response_cache_evictions_total counter",
+        f"llm_response_cache_evictions_total {cache_stats['evictions']}",
+    ]
+    return Response(metrics.render_prometheus() + "\n".join(cache_lines) + "\n", mimetype="text/plain")
+
+@app.route('/trace')
+def trace_endpoint():
+    # Chrome trace-event JSON of the sampled spans in the buffer; save it and open it in chrome://tracing or Perfetto
+    return jsonify(tracer.to_chrome_trace())
+
+def emit_task_update(event, data, to=None):
+    socketio.emit(event, data, to=to)
+
+task_node_stream = TaskNodeStream(emit_task_update)
+
+@socketio.on('connect')
+def handle_connect():
+    print('Client connected')
+    task_node_stream.send_snapshot(to=request.sid)
+
+@socketio.on('resync')
+def handle_resync():
+    task_node_stream.send_snapshot(to=request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    print('Client disconnected')
+
+# Set in service mode (--serve)
+planning_service = None
+
+def submit_job(data):
+    try:
+        return planning_service.submit(data or {}), None
+    except (KeyError, TypeError, ValueError) as e:
+        return None, (f"Invalid job: {e}", 400)
+    except queue.Full:
+        return None, ("Too many queued jobs, try again later", 503)
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    if planning_service is None:
+        return jsonify({"error": "Not running in service mode"}), 404
+    job, error = submit_job(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    if planning_service is None:
+        return jsonify({"error": "Not running in service mode"}), 404
+    return jsonify({"jobs": planning_service.list(), "queued": planning_service.queued()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = planning_service.get(job_id) if planning_service else None
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = planning_service.get(job_id) if planning_service else None
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if not job.finished:
+        return jsonify(dict(job.to_dict(), error="Job has not finished")), 409
+    return jsonify(dict(job.to_dict(), plan=task_node_to_dict(job.plan) if job.plan else None))
+
+@socketio.on('submit_job')
+def handle_submit_job(data):
+    if planning_service is None:
+        return {"error": "Not running in service mode"}
+    job, error = submit_job(data)
+    if error:
+        return {"error": error[0]}
+    join_room(job.room)
+    return job.to_dict()
+
+@socketio.on('join_job')
+def handle_join_job(data):
+    job = planning_service.get((data or {}).get("job_id")) if planning_service else None
+    if job is None:
+        return {"error": "Unknown job"}
+    join_room(job.room)
+    job.stream.send_snapshot(to=request.sid)
+    return job.to_dict()
+
+@socketio.on('leave_job')
+def handle_leave_job(data):
+    job = planning_service.get((data or {}).get("job_id")) if planning_service else None
+    if job is not None:
+        leave_room(job.room)
+
+def send_task_node_update(task_node):
+    task_node_stream.update(task_node)
+
+def run_server():
+    socketio.run(app, host="127.0.0.1", debug=True, use_reloader=False, port=5000, allow_unsafe_werkzeug=True, log_output=False)
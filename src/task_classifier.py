@@ -0,0 +1,304 @@
+# Local classifier for the primitive and executability checks
+# Hashed word and character n-grams of the task, and of the capabilities for the executability check, feed one
+# logistic regression per check. Predictions take microseconds on the
+# CPU; only verdicts below the confidence threshold are left to the LLM. Trained from the examples the LLM checks
+# log during planning and from the executed tasks in the state change log.
+#
+#   python task_classifier.py train     train on the logged examples and write the model file
+#   python task_classifier.py report    accuracy, coverage and latency of the current model file
+
+import os
+import re
+import json
+import math
+import time
+import zlib
+import random
+import argparse
+import threading
+
+MODEL_PATH = os.environ.get("TASK_CLASSIFIER_PATH", "models/task_classifier.json")
+CONFIDENCE_THRESHOLD = float(os.environ.get("TASK_CLASSIFIER_CONFIDENCE", 0.9))
+EXAMPLES_PATH = "logs/classifier_examples.jsonl"
+STATE_CHANGES_PATH = "../state_changes/state_changes.log"
+
+MODEL_FORMAT = "htn-task-classifier"
+MODEL_VERSION = 2
+N_FEATURES = 2 ** 18
+HEADS = ("primitive", "executable")
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def feature_index(feature):
+    return zlib.crc32(feature.encode("utf-8")) % N_FEATURES
+
+
+def extract_features(task, state="", capabilities=""):
+    words = WORD_PATTERN.findall(task.lower())
+    features = {}
+
+    def add(feature):
+        index = feature_index(feature)
+        features[index] = features.get(index, 0.0) + 1.0
+
+    for index, word in enumerate(words):
+        add(f"w:{word}")
+        if index == 0:
+            add(f"first:{word}")
+        if index + 1 < len(words):
+            add(f"b:{word} {words[index + 1]}")
+    text = " ".join(words)
+    for index in range(len(text) - 2):
+        add(f"c:{text[index:index + 3]}")
+
+    # Whether the objects the task mentions appear in the state at all
+    if state:
+        state_words = set(WORD_PATTERN.findall(str(state).lower()))
+        shared = sum(1 for word in words if word in state_words)
+        add(f"shared:{min(shared, 3)}")
+
+    # The same task is executable by one robot and not by another, so the verdict is keyed by the capabilities too:
+    # their words, and how many of the task's words they cover
+    if capabilities:
+        capability_words = set(WORD_PATTERN.findall(str(capabilities).lower()))
+        for word in capability_words:
+            add(f"k:{word}")
+        covered = sum(1 for word in words if word in capability_words)
+        add(f"covered:{min(covered, 3)}")
+        for word in words:
+            add(f"{'kw' if word in capability_words else 'nk'}:{word}")
+
+    norm = math.sqrt(sum(value * value for value in features.values())) or 1.0
+    return {index: value / norm for index, value in features.items()}
+
+
+class LinearHead:
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = weights or {}
+        self.bias = bias
+
+    def probability(self, features):
+        score = self.bias + sum(self.weights.get(index, 0.0) * value for index, value in features.items())
+        if score < -35:
+            return 0.0
+        return 1.0 / (1.0 + math.exp(-score))
+
+    def train(self, examples, epochs=20, learning_rate=0.5, l2=1e-4, seed=0):
+        examples = list(examples)
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(examples)
+            rate = learning_rate / (1 + epoch)
+            for features, label in examples:
+                error = self.probability(features) - (1.0 if label else 0.0)
+                self.bias -= rate * error
+                for index, value in features.items():
+                    weight = self.weights.get(index, 0.0)
+                    self.weights[index] = weight - rate * (error * value + l2 * weight)
+
+
+class TaskClassifier:
+    def __init__(self, heads=None, threshold=CONFIDENCE_THRESHOLD):
+        self.heads = heads or {}
+        self.threshold = threshold
+
+    def predict(self, head, task, state="", capabilities=""):
+        # (label, confidence), or (None, 0.0) when the model has no such head
+        model = self.heads.get(head)
+        if model is None:
+            return None, 0.0
+        probability = model.probability(extract_features(task, state, capabilities))
+        return probability >= 0.5, max(probability, 1 - probability)
+
+    def confident_verdict(self, head, task, state="", capabilities=""):
+        label, confidence = self.predict(head, task, state, capabilities)
+        return label if confidence >= self.threshold else None
+
+    def save(self, path):
+        model_dir = os.path.dirname(path)
+        if model_dir and not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        data = {
+            "format": MODEL_FORMAT,
+            "version": MODEL_VERSION,
+            "n_features": N_FEATURES,
+            "heads": {
+                name: {"bias": head.bias,
+                       "weights": {str(index): round(weight, 6) for index, weight in head.weights.items()
+                                   if abs(weight) > 1e-6}}
+                for name, head in self.heads.items()
+            },
+        }
+        with open(path, "w") as model_file:
+            json.dump(data, model_file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path, threshold=CONFIDENCE_THRESHOLD):
+        with open(path) as model_file:
+            data = json.load(model_file)
+        if data.get("format") != MODEL_FORMAT or data.get("version") != MODEL_VERSION:
+            raise ValueError(f"Unsupported classifier model file: {path}")
+        if data["n_features"] != N_FEATURES:
+            raise ValueError(f"Classifier model {path} was trained with {data['n_features']} features")
+        heads = {
+            name: LinearHead({int(index): weight for index, weight in head["weights"].items()}, head["bias"])
+            for name, head in data["heads"].items()
+        }
+        return cls(heads, threshold)
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier():
+    # The model file is optional; without one every check goes to the LLM
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            try:
+                _classifier = TaskClassifier.load(MODEL_PATH)
+            except (OSError, ValueError) as e:
+                if os.path.exists(MODEL_PATH):
+                    print(f"Could not load task classifier: {e}")
+                _classifier = TaskClassifier()
+        return _classifier
+
+
+def confident_verdict(head, task, state="", capabilities=""):
+    return get_classifier().confident_verdict(head, task, state, capabilities)
+
+
+def log_classifier_example(head, task, state, label, capabilities=""):
+    log_dir = os.path.dirname(EXAMPLES_PATH)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    with open(EXAMPLES_PATH, "a") as log_file:
+        example = {"head": head, "task": task, "state": str(state), "label": bool(label)}
+        if capabilities:
+            example["capabilities"] = str(capabilities)
+        log_file.write(json.dumps(example) + "\n")
+
+
+def load_examples(examples_path=EXAMPLES_PATH, state_changes_path=STATE_CHANGES_PATH):
+    examples = {head: [] for head in HEADS}
+
+    if os.path.exists(examples_path):
+        with open(examples_path) as examples_file:
+            for line in examples_file:
+                try:
+                    example = json.loads(line)
+                except ValueError:
+                    continue
+                if example.get("head") == "executable" and not example.get("capabilities"):
+                    # Logged before capabilities were recorded; the verdict cannot be tied to a robot
+                    continue
+                if example.get("head") in examples:
+                    examples[example["head"]].append((example["task"], example.get("state", ""),
+                                                      example.get("capabilities", ""), example["label"]))
+
+    # Every executed task was primitive; the negative examples are the tasks the planner decomposed, which it logs
+    # as it goes. The log does not record the capabilities a task was executed with, so it gives no examples for
+    # the executability check
+    if os.path.exists(state_changes_path):
+        task_pattern = re.compile(r"Executing task '(.*)'$")
+        state_pattern = re.compile(r"Previous state: '(.*)'$")
+        task = None
+        with open(state_changes_path) as log_file:
+            for line in log_file:
+                line = line.rstrip("\n")
+                match = task_pattern.search(line)
+                if match:
+                    task = match.group(1)
+                    continue
+                match = state_pattern.search(line)
+                if match and task is not None:
+                    examples["primitive"].append((task, "", "", True))
+                    task = None
+
+    return examples
+
+
+def split(examples, holdout=0.2, seed=0):
+    examples = list(examples)
+    random.Random(seed).shuffle(examples)
+    cut = int(len(examples) * (1 - holdout))
+    return examples[:cut], examples[cut:]
+
+
+def evaluate(classifier, head, examples):
+    correct = confident = confident_correct = 0
+    start = time.perf_counter()
+    for task, state, capabilities, label in examples:
+        prediction, confidence = classifier.predict(head, task, state, capabilities)
+        correct += prediction == label
+        if confidence >= classifier.threshold:
+            confident += 1
+            confident_correct += prediction == label
+    elapsed = time.perf_counter() - start
+    count = len(examples) or 1
+    return {
+        "examples": len(examples),
+        "accuracy": correct / count,
+        "coverage": confident / count,
+        "confident_accuracy": confident_correct / confident if confident else 0.0,
+        "latency_us": elapsed / count * 1e6,
+    }
+
+
+def print_report(head, report):
+    print(f"{head:<11} examples={report['examples']:<5} accuracy={report['accuracy']:.3f} "
+          f"coverage@threshold={report['coverage']:.3f} confident_accuracy={report['confident_accuracy']:.3f} "
+          f"latency={report['latency_us']:.1f}us")
+
+
+def train(args):
+    examples = load_examples(args.examples, args.state_changes)
+    classifier = TaskClassifier(threshold=args.threshold)
+    for head in HEADS:
+        if not examples[head]:
+            print(f"{head:<11} no examples, skipped")
+            continue
+        if len({label for _, _, _, label in examples[head]}) < 2:
+            # A head trained on one label answers it for every task, confidently
+            print(f"{head:<11} only {'positive' if examples[head][0][3] else 'negative'} examples, skipped")
+            continue
+        training, holdout = split(examples[head])
+        model = LinearHead()
+        model.train([(extract_features(task, state, capabilities), label)
+                     for task, state, capabilities, label in training], epochs=args.epochs)
+        classifier.heads[head] = model
+        print_report(head, evaluate(classifier, head, holdout or training))
+
+    classifier.save(args.model)
+    print(f"Model written to {args.model}")
+
+
+def report(args):
+    classifier = TaskClassifier.load(args.model, args.threshold)
+    examples = load_examples(args.examples, args.state_changes)
+    for head in HEADS:
+        if head in classifier.heads and examples[head]:
+            print_report(head, evaluate(classifier, head, examples[head]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the local task classifier")
+    parser.add_argument("command", choices=["train", "report"])
+    parser.add_argument("--examples", default=EXAMPLES_PATH)
+    parser.add_argument("--state-changes", default=STATE_CHANGES_PATH)
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--threshold", type=float, default=CONFIDENCE_THRESHOLD)
+    parser.add_argument("--epochs", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train(args)
+    else:
+        report(args)
+
+
+if __name__ == '__main__':
+    main()
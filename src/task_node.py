@@ -1,31 +1,177 @@
+# Task tree
+# Every node belongs to a TaskTree arena that hands out integer ids; node names are "<tree uid>:<id>". Nodes are
+# slotted, task names are interned and statuses are stored as one-byte codes while reading and writing as the
+# usual strings. Children are insertion-ordered dicts, so removing one is O(1), and every traversal is iterative.
+
+import sys
+import enum
 import uuid
+import struct
+
+TREE_MAGIC = b"HTNT"
+TREE_VERSION = 1
+HEADER = struct.Struct("<4sHI")
+NODE = struct.Struct("<IiBI")
+
+
+class TaskStatus(enum.IntEnum):
+    PENDING = 0
+    IN_PROGRESS = 1
+    COMPLETED = 2
+    FAILED = 3
+    SUCCEEDED = 4
+    # Not decomposed (or not executed) before the budget of an anytime run ran out; to be refined later
+    UNEXPANDED = 5
+
+
+STATUS_NAMES = ("pending", "in-progress", "completed", "failed", "succeeded", "unexpanded")
+STATUS_CODES = {name: TaskStatus(code) for code, name in enumerate(STATUS_NAMES)}
+
 
-from text_utils import trace_function_calls
+class TaskTree:
+    def __init__(self, uid=None):
+        self.uid = uid or uuid.uuid4().hex[:8]
+        self.nodes = []
+
+    def allocate(self, node, node_id=None):
+        if node_id is None:
+            node_id = len(self.nodes)
+        while len(self.nodes) <= node_id:
+            self.nodes.append(None)
+        if self.nodes[node_id] is not None:
+            raise ValueError(f"Node id {node_id} is already used in tree {self.uid}")
+        self.nodes[node_id] = node
+        return node_id
+
+    def get(self, node_id):
+        return self.nodes[node_id] if 0 <= node_id < len(self.nodes) else None
+
+    def adopt(self, node):
+        # Moves a subtree from another tree (or a released one) into this arena under new ids
+        for child, _ in node.walk():
+            if child.tree is not None and child.tree.get(child.node_id) is child:
+                child.tree.nodes[child.node_id] = None
+            child.tree = self
+            child.node_id = self.allocate(child)
+
+    def release(self, node):
+        # Frees the arena slots of a subtree that was removed from the tree
+        for child, _ in node.walk():
+            if self.get(child.node_id) is child:
+                self.nodes[child.node_id] = None
+
+    def __len__(self):
+        return sum(1 for node in self.nodes if node is not None)
 
 
 class TaskNode:
-    def __init__(self, task_name, parent=None, status="pending"):
-        self.task_name = task_name
-        self.node_name = str(uuid.uuid4())
+    __slots__ = ("tree", "node_id", "_task_name", "_status", "parent", "_children")
+
+    def __init__(self, task_name, parent=None, status="pending", tree=None, node_id=None):
+        if tree is None:
+            tree = parent.tree if parent is not None else TaskTree()
+        self.tree = tree
+        self.node_id = self.tree.allocate(self, node_id)
+        self._task_name = sys.intern(task_name)
+        self._status = STATUS_CODES[status]
         self.parent = parent
-        self.children = []
-        self.status = status
+        self._children = {}
+
+    @property
+    def node_name(self):
+        return f"{self.tree.uid}:{self.node_id}"
+
+    @property
+    def task_name(self):
+        return self._task_name
+
+    @task_name.setter
+    def task_name(self, task_name):
+        self._task_name = sys.intern(task_name)
+
+    @property
+    def status(self):
+        return STATUS_NAMES[self._status]
+
+    @status.setter
+    def status(self, status):
+        self._status = STATUS_CODES[status] if isinstance(status, str) else TaskStatus(status)
+
+    @property
+    def children(self):
+        return list(self._children)
 
-    @trace_function_calls
     def add_child(self, child_node):
-        self.children.append(child_node)
+        if child_node.parent is not None and child_node.parent is not self:
+            child_node.parent.remove_child(child_node)
+        if child_node.tree is not self.tree or self.tree.get(child_node.node_id) is not child_node:
+            self.tree.adopt(child_node)
+        self._children[child_node] = None
         child_node.parent = self
 
-    @trace_function_calls
     def remove_child(self, child_node):
-        if child_node in self.children:
-            self.children.remove(child_node)
+        if child_node in self._children:
+            del self._children[child_node]
             child_node.parent = None
+            self.tree.release(child_node)
 
-    @trace_function_calls
     def update_task_name(self, task_name):
         self.task_name = task_name
 
+    def walk(self):
+        # Preorder (node, depth) pairs, without recursion
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            stack.extend((child, depth + 1) for child in reversed(node.children))
+
+    def to_dict(self):
+        root = None
+        stack = [(self, None)]
+        while stack:
+            node, siblings = stack.pop()
+            entry = {"task_name": node.task_name, "status": node.status, "children": []}
+            if siblings is None:
+                root = entry
+            else:
+                siblings.append(entry)
+            stack.extend((child, entry["children"]) for child in reversed(node.children))
+        return root
+
+    def to_bytes(self):
+        # Header, tree uid, then one record per node in preorder: id, parent id (-1 for this node), status and name
+        uid = self.tree.uid.encode("utf-8")
+        parts = [HEADER.pack(TREE_MAGIC, TREE_VERSION, len(uid)), uid]
+        for node, _ in self.walk():
+            name = node.task_name.encode("utf-8")
+            parent_id = node.parent.node_id if node is not self else -1
+            parts.append(NODE.pack(node.node_id, parent_id, node._status, len(name)))
+            parts.append(name)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, uid_length = HEADER.unpack_from(data, 0)
+        if magic != TREE_MAGIC or version != TREE_VERSION:
+            raise ValueError("Not a serialized task tree")
+        offset = HEADER.size
+        tree = TaskTree(bytes(data[offset:offset + uid_length]).decode("utf-8"))
+        offset += uid_length
+
+        root = None
+        while offset < len(data):
+            node_id, parent_id, status, name_length = NODE.unpack_from(data, offset)
+            offset += NODE.size
+            name = bytes(data[offset:offset + name_length]).decode("utf-8")
+            offset += name_length
+            node = cls(name, status=STATUS_NAMES[status], tree=tree, node_id=node_id)
+            if parent_id < 0:
+                root = node
+            else:
+                tree.get(parent_id).add_child(node)
+        return root
+
     def all_children_succeeded(self):
         return all(child.status == 'succeeded' for child in self.children)
 
@@ -33,4 +179,7 @@ class TaskNode:
         if self.all_children_succeeded():
             self.status = 'succeeded'
         else:
-            print(f"Cannot mark {self.task_name} as succeeded because some children tasks are still pending.")
\ No newline at end of file
+            print(f"Cannot mark {self.task_name} as succeeded because some children tasks are still pending.")
+
+    def __repr__(self):
+        return f"TaskNode({self.task_name!r}, status={self.status!r}, node_name={self.node_name!r})"
@@ -0,0 +1,137 @@
+# Incremental task tree updates for the frontend
+# Instead of the whole tree, clients receive patches keyed on TaskNode.node_name (node-added, status-changed,
+# node-removed). Patches produced within a short window are coalesced into one event; a full snapshot is only
+# sent when a client connects or asks to resync.
+
+import threading
+
+PATCH_EVENT = "task_node_patch"
+SNAPSHOT_EVENT = "task_node_snapshot"
+
+
+class TaskNodeStream:
+    def __init__(self, emit, window=0.05):
+        # emit(event, data, to=None) sends to every client when `to` is None
+        self.emit = emit
+        self.window = window
+        self.nodes = {}
+        self.root = None
+        self._pending = []
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def update(self, task_node):
+        with self._lock:
+            self._sync_ancestors(task_node)
+            self._sync_node(task_node)
+            if self._pending and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _sync_ancestors(self, task_node):
+        # The topmost unknown ancestor is added with its subtree, which includes task_node itself
+        top = None
+        node = task_node
+        while node is not None and node.node_name not in self.nodes:
+            top = node
+            node = node.parent
+        if top is not None:
+            self._add(top)
+
+    def _add(self, task_node):
+        # Adds the node and its whole subtree, parents before children
+        stack = [task_node]
+        while stack:
+            node = stack.pop()
+            parent_name = node.parent.node_name if node.parent is not None else None
+            if parent_name is None:
+                if self.root is not None and self.root != node.node_name:
+                    self._remove(self.root)
+                self.root = node.node_name
+            self.nodes[node.node_name] = {
+                "node_name": node.node_name,
+                "task_name": node.task_name,
+                "status": node.status,
+                "parent": parent_name,
+                "children": [child.node_name for child in node.children],
+            }
+            if parent_name in self.nodes and node.node_name not in self.nodes[parent_name]["children"]:
+                self.nodes[parent_name]["children"].append(node.node_name)
+            self._pending.append({
+                "op": "node-added",
+                "node_name": node.node_name,
+                "parent": parent_name,
+                "task_name": node.task_name,
+                "status": node.status,
+            })
+            stack.extend(reversed(node.children))
+
+    def _remove(self, node_name):
+        entry = self.nodes.get(node_name)
+        if entry is None:
+            return
+        parent = self.nodes.get(entry["parent"])
+        if parent is not None and node_name in parent["children"]:
+            parent["children"].remove(node_name)
+        stack = [node_name]
+        while stack:
+            removed = self.nodes.pop(stack.pop(), None)
+            if removed:
+                stack.extend(removed["children"])
+        self._pending.append({"op": "node-removed", "node_name": node_name})
+
+    def _sync_node(self, task_node):
+        entry = self.nodes.get(task_node.node_name)
+        if entry is None:
+            self._add(task_node)
+            return
+
+        if entry["status"] != task_node.status:
+            entry["status"] = task_node.status
+            self._pending.append({"op": "status-changed", "node_name": task_node.node_name,
+                                  "status": task_node.status})
+
+        current = {child.node_name for child in task_node.children}
+        for child_name in list(entry["children"]):
+            if child_name not in current:
+                self._remove(child_name)
+        for child in task_node.children:
+            if child.node_name not in self.nodes:
+                self._add(child)
+            elif self.nodes[child.node_name]["status"] != child.status:
+                self._sync_node(child)
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            patches = coalesce(self._pending)
+            self._pending = []
+        if patches:
+            self.emit(PATCH_EVENT, {"patches": patches})
+
+    def snapshot(self):
+        # Flushes first so that the snapshot and the patch stream agree
+        self.flush()
+        with self._lock:
+            return {"root": self.root, "nodes": [dict(entry, children=list(entry["children"]))
+                                                 for entry in self.nodes.values()]}
+
+    def send_snapshot(self, to=None):
+        self.emit(SNAPSHOT_EVENT, self.snapshot(), to=to)
+
+
+def coalesce(patches):
+    # Folds status changes into the earlier patch for the same node within the burst
+    coalesced = []
+    latest = {}
+    for patch in patches:
+        node_name = patch["node_name"]
+        previous = latest.get(node_name)
+        if patch["op"] == "status-changed" and previous is not None and previous["op"] != "node-removed":
+            previous["status"] = patch["status"]
+            continue
+        patch = dict(patch)
+        coalesced.append(patch)
+        latest[node_name] = patch
+    return coalesced
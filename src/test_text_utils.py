@@ -0,0 +1,95 @@
+# Tests for the subtask list parser: known model outputs, fuzzed outputs and throughput on large inputs
+
+import time
+import random
+
+import pytest
+
+from text_utils import parse_list
+
+PARSER_CASES = [
+    ("['grab the cup', 'move to the sink']", ["grab the cup", "move to the sink"]),
+    ('["grab the cup", "move to the sink"]', ["grab the cup", "move to the sink"]),
+    ("Here is the plan:\n```python\n['grab the robot's arm', 'lift it']\n```\nLet me know!",
+     ["grab the robot's arm", "lift it"]),
+    ('{"subtasks": ["open the fridge", "grab the milk"]}', ["open the fridge", "grab the milk"]),
+    ("Here is the plan [as requested]:\n['grab the cup', 'move to the sink']", ["grab the cup", "move to the sink"]),
+    ("Sure! {note: brief}\n['grab the cup', 'move to the sink']", ["grab the cup", "move to the sink"]),
+    ("[Note] Here's the list: ['grab the cup', 'move to the sink']", ["grab the cup", "move to the sink"]),
+    ("[1] I'd suggest: ['grab the cup', 'move to the sink']", ["grab the cup", "move to the sink"]),
+    ('[{"subtask": "open the fridge", "type": "primitive"}, {"subtask": "make coffee", "type": "compound"}]',
+     ["open the fridge", "make coffee"]),
+    ("[{'step': 1, 'action': 'grab the cup'}, {'step': 2, 'action': 'lift it'}]", ["grab the cup", "lift it"]),
+    ("[(1, 'grab the cup'), (2, 'lift it')]", ["grab the cup", "lift it"]),
+    ("[{task: grab the cup}, {task: lift it}]", ["grab the cup", "lift it"]),
+    ("[('open the fridge', 'primitive'), ('make coffee', 'compound')]", ["open the fridge", "make coffee"]),
+    ("1. open the fridge\n2. grab the milk\n3. close the fridge", ["open the fridge", "grab the milk",
+                                                                    "close the fridge"]),
+    ("Steps:\n- open the fridge\n* grab the milk", ["open the fridge", "grab the milk"]),
+    ("['open the fridge', 'grab the mi", ["open the fridge", "grab the mi"]),
+    ("[open the fridge, grab the milk]", ["open the fridge", "grab the milk"]),
+    ("['open the fridge' 'grab the milk',]", ["open the fridge", "grab the milk"]),
+    ('["say \\"hello\\"", "caf\\u00e9"]', ['say "hello"', "café"]),
+    ("[Step 1: open the fridge, Step 2: grab the milk]", ["Step 1: open the fridge", "Step 2: grab the milk"]),
+    ("Note [see below]:\n1. open the fridge\n2. grab the milk", ["open the fridge", "grab the milk"]),
+    ("[]", []),
+    ("I cannot help with that.", None),
+    ("[", None),
+]
+FUZZ_ALPHABET = "[]{}()'\",:\\\n` -*1.abc"
+
+# Inputs that grow in size, including ones that make regexes backtrack
+THROUGHPUT_INPUTS = {
+    "long list": lambda size: repr([f"subtask number {index}" for index in range(size // 20)]),
+    "open brackets": lambda size: "[" * size,
+    "bracketed chatter": lambda size: "[a] it's " * (size // 9),
+    "quotes": lambda size: "['" + "a' b " * (size // 5),
+    "separators": lambda size: "[a" + "," * size,
+    "numbered lines": lambda size: "1. step\n" * (size // 8),
+}
+
+
+@pytest.mark.parametrize("text, expected", PARSER_CASES)
+def test_parse_list(text, expected):
+    assert parse_list(text) == expected
+
+
+def mutate(rng, text):
+    text = list(text)
+    for _ in range(rng.randint(1, 6)):
+        position = rng.randint(0, len(text))
+        operation = rng.random()
+        if operation < 0.4:
+            text.insert(position, rng.choice(FUZZ_ALPHABET))
+        elif operation < 0.8:
+            del text[position:position + 1]
+        else:
+            del text[position:]
+    return "".join(text)
+
+
+def test_fuzzed_outputs_give_strings_or_none():
+    # Truncated, mangled and random outputs must give a list of strings or None, never an exception
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = mutate(rng, rng.choice(PARSER_CASES)[0])
+        result = parse_list(text)
+        assert result is None or all(isinstance(item, str) for item in result), text
+
+
+@pytest.mark.parametrize("name", THROUGHPUT_INPUTS)
+def test_time_grows_linearly(name):
+    # Time per character has to stay about flat as inputs grow four times larger; the best of three runs is
+    # compared to keep scheduling noise out
+    rates = []
+    for size in (25000, 100000):
+        text = THROUGHPUT_INPUTS[name](size)
+        elapsed = min(timed_parse(text) for _ in range(3))
+        rates.append(elapsed / len(text))
+    assert rates[1] / rates[0] < 3
+
+
+def timed_parse(text):
+    start = time.perf_counter()
+    parse_list(text)
+    return time.perf_counter() - start
@@ -2,8 +2,10 @@ import os
 import re
 import datetime
 
+PARSING_ERRORS_DIR = "../parsing_errors"
+
 def log_parsing_errors(input_text, extracted_list):
-    log_dir = "../parsing_errors"
+    log_dir = PARSING_ERRORS_DIR
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
@@ -14,55 +16,259 @@ def log_parsing_errors(input_text, extracted_list):
         log_file.write(f"{timestamp}: Input text:\n{input_text}\n")
         log_file.write(f"{timestamp}: Extracted list:\n{', '.join(extracted_list)}\n\n")
 
-def trace_function_calls(func):
-    def wrapper(*args, **kwargs):
-        with open('function_trace.log', 'a') as log_file:
-            log_file.write(f"Function {func.__name__} called with arguments {args} and keyword arguments {kwargs}\n")
-        result = func(*args, **kwargs)
-        with open('function_trace.log', 'a') as log_file:
-            log_file.write(f"Function {func.__name__} returned {result}\n")
-        return result
-    return wrapper
-
-@trace_function_calls
-def extract_lists(text):
-    # Define patterns
-    subtask_pattern = r'\[((?:[^\[\]]|\[[^\[\]]*\])*)\]'
-    url_pattern = r'https?://\S+'
-    command_pattern = r"(?<!\[)'(?:[^']|'')*?'(?!\])"
-    backtick_command_pattern = r"`(.+?)`"
-
-    # Replace URLs and commands with placeholders
-    url_placeholder = "URL_PLACEHOLDER"
-    command_placeholder = "COMMAND_PLACEHOLDER"
-    urls_replacements = re.findall(url_pattern, text)
-    commands_replacements = re.findall(command_pattern, text)
-    text = re.sub(url_pattern, url_placeholder, text)
-    text = re.sub(command_pattern, command_placeholder, text)
-
-    # Extract subtasks
-    subtask_list = re.findall(subtask_pattern, text)
-    backtick_command_list = re.findall(backtick_command_pattern, text)
-
-    # Combine lists
-    combined_list = subtask_list + backtick_command_list
-
-    # Clean list items by removing trailing punctuation marks and restoring URLs and commands
-    cleaned_list = []
-    for item in combined_list:
-        cleaned_item = item.rstrip('.!?')
-
-        # Check if the cleaned item is shorter than the original and ends with a word character
-        # If so, append the last character from the original item
-        if len(cleaned_item) < len(item) and re.search(r'\w$', item):
-            cleaned_item += item[-1]
-
-        # Restore URLs and commands
-        while url_placeholder in cleaned_item and urls_replacements:
-            cleaned_item = cleaned_item.replace(url_placeholder, urls_replacements.pop(0), 1)
-        while command_placeholder in cleaned_item and commands_replacements:
-            cleaned_item = cleaned_item.replace(command_placeholder, commands_replacements.pop(0), 1)
-
-        cleaned_list.append(cleaned_item)
-
-    return cleaned_list
\ No newline at end of file
+# Structured output parsing
+# parse_list reads a list of strings out of a model response in one pass over the text, without eval and without
+# backtracking regexes. It accepts Python and JSON lists (also inside a JSON object, code fences or surrounding
+# chatter), lists of objects or tuples, and numbered or bulleted lines. Truncated or slightly malformed output is
+# repaired: unterminated strings and brackets are closed, unquoted items are kept and missing commas are tolerated.
+# Returns None only when no list can be found at all.
+
+BRACKET_PATTERN = re.compile(r"[\[{]")
+LIST_LINE_PATTERN = re.compile(r"^\s*(?:[-*\u2022+]|\d{1,3}[.)]|\(\d{1,3}\))\s+(.+?)\s*$")
+ITEM_KEYS = ("subtask", "task", "name", "step", "action", "description")
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+STRING_CLOSERS = ",]}):'\""
+STRUCTURE = "[]{}(),:"
+
+
+class BareText(str):
+    # Unquoted text, which is only trusted as a list item when no numbered or bulleted list is found instead
+    pass
+
+
+def tokenize(text, start):
+    # Yields (kind, value, end) tokens; kind is a structure character, "str" or "bare", end the index after it
+    index = start
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if char.isspace():
+            index += 1
+        elif char in STRUCTURE:
+            index += 1
+            yield char, char, index
+        elif char in "'\"":
+            value, index = read_string(text, index + 1, char)
+            yield "str", value, index
+        elif char == "`" and text.startswith("```", index):
+            # A closing code fence ends the output
+            return
+        else:
+            end = index
+            while end < length and text[end] not in STRUCTURE and text[end] not in "\n'\"":
+                end += 1
+            yield "bare", BareText(text[index:end].strip()), end
+            index = end
+
+
+def read_string(text, index, quote):
+    # A quote only closes the string when the next non-blank character ends a value, so apostrophes inside
+    # single-quoted items ("robot's arm") are kept. An unterminated string runs to the end of the text
+    chars = []
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if char == "\\" and index + 1 < length:
+            escaped = text[index + 1]
+            if escaped == "u" and index + 5 < length:
+                try:
+                    chars.append(chr(int(text[index + 2:index + 6], 16)))
+                    index += 6
+                    continue
+                except ValueError:
+                    pass
+            chars.append(ESCAPES.get(escaped, escaped))
+            index += 2
+            continue
+        if char == quote:
+            after = index + 1
+            while after < length and text[after] in " \t\r":
+                after += 1
+            if after >= length or text[after] in STRING_CLOSERS or text[after] == "\n":
+                return "".join(chars), index + 1
+        chars.append(char)
+        index += 1
+    return "".join(chars), index
+
+
+def build_value(tokens):
+    # Builds nested lists and dicts from the token stream; missing closing brackets are added at the end.
+    # Returns the value and the index in the text where it ends
+    root = []
+    stack = [root]
+    key = None
+    joining = False
+    end = 0
+    for kind, value, end in tokens:
+        container = stack[-1]
+        if kind in "[(":
+            item = []
+        elif kind == "{":
+            item = {}
+        elif kind in "])}":
+            if len(stack) > 1:
+                stack.pop()
+            if len(stack) == 1:
+                break
+            continue
+        elif kind == ",":
+            key = None
+            joining = False
+            continue
+        elif kind == ":":
+            if isinstance(container, dict) and key is None and isinstance(container.get(None), str):
+                key = container.pop(None)
+            elif isinstance(container, list) and container and isinstance(container[-1], str):
+                # "Step 1: grab the cup" is one item
+                joining = True
+            continue
+        elif joining and isinstance(container, list) and container and isinstance(container[-1], str):
+            container[-1] = type(container[-1])(f"{container[-1]}: {value}")
+            joining = False
+            continue
+        else:
+            item = value
+
+        if isinstance(container, dict):
+            if key is not None:
+                container[key] = item
+                key = None
+            else:
+                # Held until a ':' shows whether it is a key or a value without one
+                container[None] = item
+        else:
+            container.append(item)
+        if isinstance(item, (list, dict)):
+            stack.append(item)
+    return (root[0] if root else None), end
+
+
+def item_text(entries):
+    # Quoted strings are preferred over unquoted text such as step numbers
+    entries = [entry for entry in entries if isinstance(entry, str)]
+    return next((entry for entry in entries if not isinstance(entry, BareText)), entries[0] if entries else None)
+
+
+def list_items(value):
+    # The first list in the value, as strings; objects and tuples contribute their task text
+    if isinstance(value, dict):
+        for item in value.values():
+            items = list_items(item)
+            if items is not None:
+                return items
+        return None
+    if not isinstance(value, list):
+        return None
+    items = []
+    for item in value:
+        if isinstance(item, dict):
+            text = item_text([item.get(key) for key in ITEM_KEYS] + list(item.values()))
+        elif isinstance(item, list):
+            text = item_text(item)
+        else:
+            text = item
+        if isinstance(text, str) and text.strip():
+            items.append(text if isinstance(text, BareText) else text.strip())
+    return items
+
+
+def parse_lines(text):
+    # Numbered or bulleted lines, for responses that are not bracketed lists
+    items = []
+    for line in text.splitlines():
+        match = LIST_LINE_PATTERN.match(line)
+        if match:
+            items.append(match.group(1).strip().strip("'\"").rstrip(",").strip())
+    return [item for item in items if item] or None
+
+
+def parse_list(text):
+    text = str(text)
+    start = BRACKET_PATTERN.search(text)
+    if start:
+        # Brackets in the chatter before the list ("[as requested]") are skipped: every value is tokenized afresh
+        # from the next bracket after the one before, so an apostrophe in between ("Here's") cannot swallow the
+        # list, and the first one with quoted items wins
+        items = None
+        while start:
+            value, end = build_value(tokenize(text, start.start()))
+            candidate = list_items(value)
+            if candidate and not all(isinstance(item, BareText) for item in candidate):
+                return [str(item) for item in candidate]
+            if items is None:
+                items = candidate
+            start = BRACKET_PATTERN.search(text, end)
+        lines = parse_lines(text)
+        if lines:
+            return lines
+        if items is None or not items and "]" not in text and "}" not in text:
+            # Nothing, or an opening bracket and then nothing before the output was cut off
+            return None
+        return [str(item) for item in items]
+    return parse_lines(text)
+
+class IncrementalListParser:
+    # Reads a Python/JSON list of strings as it streams in and returns each string as soon as it is complete.
+    # A quote only closes a string when the next non-blank character is ',' or ']', so apostrophes inside
+    # single-quoted items ("robot's arm") do not end them early.
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self._started = False
+        self._quote = None
+        self._buffer = []
+        self._escaped = False
+        self._closing = False
+
+    def feed(self, chunk):
+        completed = []
+        for char in chunk:
+            if self.done:
+                break
+            if not self._started:
+                self._started = char == "["
+            elif self._quote is None:
+                if char in "'\"":
+                    self._quote = char
+                elif char == "]":
+                    self.done = True
+            elif self._closing:
+                if char.isspace():
+                    continue
+                if char in ",]":
+                    completed.append(self._finish())
+                    self.done = char == "]"
+                else:
+                    # The quote was part of the text
+                    self._buffer.append(self._quote)
+                    self._closing = False
+                    self._consume(char)
+            else:
+                self._consume(char)
+        self.items.extend(completed)
+        return completed
+
+    def _consume(self, char):
+        if self._escaped:
+            self._buffer.append({"n": "\n", "t": "\t"}.get(char, char))
+            self._escaped = False
+        elif char == "\\":
+            self._escaped = True
+        elif char == self._quote:
+            self._closing = True
+        else:
+            self._buffer.append(char)
+
+    def _finish(self):
+        item = "".join(self._buffer)
+        self._buffer = []
+        self._quote = None
+        self._closing = False
+        return item
+
+    def close(self):
+        # A string whose closing quote was the last character of the stream
+        completed = [self._finish()] if self._closing else []
+        self.items.extend(completed)
+        self.done = True
+        return completed
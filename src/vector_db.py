@@ -1,20 +1,163 @@
-import chromadb
+import os
+import json
+import hashlib
+import threading
+
+from world_state import WorldState
+
+# Completed decompositions persist across runs and are reused for tasks at least this similar (cosine), entered in
+# a state whose facts about the task overlap at least this much (Jaccard) with the state the decomposition was made in
+PLAN_LIBRARY_PATH = os.environ.get("PLAN_LIBRARY_PATH", "plan_library")
+PLAN_REUSE_THRESHOLD = float(os.environ.get("PLAN_REUSE_THRESHOLD", 0.9))
+PLAN_STATE_THRESHOLD = float(os.environ.get("PLAN_STATE_THRESHOLD", 0.6))
+# Nearest stored tasks compared against the current state
+PLAN_REUSE_CANDIDATES = int(os.environ.get("PLAN_REUSE_CANDIDATES", 5))
+
+
+def serialize_decomposition(task_node):
+    root = None
+    stack = [(task_node, None)]
+    while stack:
+        node, siblings = stack.pop()
+        entry = {"task": node.task_name, "subtasks": []}
+        if siblings is None:
+            root = entry
+        else:
+            siblings.append(entry)
+        stack.extend((child, entry["subtasks"]) for child in reversed(node.children))
+    return root
+
+
+def task_facts(task_name, state):
+    # The facts of a state that mention the task, which are the ones its decomposition depends on
+    return WorldState.from_text(state).relevant_to(task_name).facts
+
+
+def state_similarity(task_name, stored_state, state):
+    stored, current = task_facts(task_name, stored_state), task_facts(task_name, state)
+    if not stored and not current:
+        return 1.0
+    return len(stored & current) / len(stored | current)
+
+
+shared_libraries = {}
+shared_libraries_lock = threading.Lock()
 
 
 class VectorDB:
-    def __init__(self):
-        # Create a chroma client
-        self.client = chromadb.Client()
+    def __init__(self, persist_directory=PLAN_LIBRARY_PATH, reuse_threshold=PLAN_REUSE_THRESHOLD,
+                 state_threshold=PLAN_STATE_THRESHOLD):
+        self.persist_directory = persist_directory
+        self.reuse_threshold = reuse_threshold
+        self.state_threshold = state_threshold
+        self._client = None
+        self._collection = None
+        # Entries stored since the library was last written to disk
+        self._unsaved = 0
+        # The async planner looks up decompositions from worker threads
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
 
-        # Create a collection
-        self.collection = self.client.create_collection("task_nodes")
+    @classmethod
+    def shared(cls, persist_directory=PLAN_LIBRARY_PATH):
+        # One instance per library for the whole process instead of a new chroma client for every plan
+        with shared_libraries_lock:
+            if persist_directory not in shared_libraries:
+                shared_libraries[persist_directory] = cls(persist_directory)
+            return shared_libraries[persist_directory]
 
-    def add_task_node(self, task_node):
-        self.collection.upsert(documents=[task_node.task_name], ids=[task_node.node_name], metadatas=[vars(task_node)])
+    def connect(self):
+        # chromadb is only imported when the library is first used
+        with self._connect_lock:
+            if self._collection is None:
+                import chromadb
+                from chromadb.config import Settings
 
-    def get_task_node(self, task_node):
-        return self.collection.get(ids=[task_node.node_name])['metadatas'][0]
+                # Create a persistent chroma client
+                self._client = chromadb.Client(Settings(chroma_db_impl="duckdb+parquet",
+                                                        persist_directory=self.persist_directory))
+                # Reuse the collection of earlier runs
+                self._collection = self._client.get_or_create_collection("task_nodes",
+                                                                         metadata={"hnsw:space": "cosine"})
+            return self._collection
+
+    @property
+    def client(self):
+        self.connect()
+        return self._client
+
+    @property
+    def collection(self):
+        return self.connect()
+
+    def warm_up(self):
+        # Also loads the embedding model, which chroma otherwise loads on the first lookup
+        with self._lock:
+            if self.collection.count() > 0:
+                self.collection.query(query_texts=["warm up"], n_results=1)
+
+    @staticmethod
+    def entry_id(task_name, capabilities, state=""):
+        # One entry per task, capability set and facts about the task, so repeated goals replace rather than pile up
+        # while decompositions made in different states are kept apart
+        facts = "\n".join(sorted(task_facts(task_name, state)))
+        return hashlib.sha1(f"{task_name}\n{capabilities}\n{facts}".encode("utf-8")).hexdigest()
+
+    def add_task_node(self, task_node, state="", capabilities=""):
+        metadata = {
+            "task_name": task_node.task_name,
+            "decomposition": json.dumps(serialize_decomposition(task_node), separators=(",", ":")),
+            "state": str(state),
+            "capabilities": str(capabilities),
+        }
+        with self._lock:
+            self.collection.upsert(documents=[task_node.task_name],
+                                   ids=[self.entry_id(task_node.task_name, capabilities, state)],
+                                   metadatas=[metadata])
+            self._unsaved += 1
+
+    def persist(self):
+        # Writing the library rewrites its parquet files, so it is done once per plan rather than per stored node
+        with self._lock:
+            if self._unsaved:
+                self.client.persist()
+                self._unsaved = 0
+
+    def get_task_node(self, task_node, capabilities="", state=""):
+        return self.collection.get(ids=[self.entry_id(task_node.task_name, capabilities, state)])['metadatas'][0]
 
     def query_by_name(self, task_name):
         task_nodes = self.collection.query(query_texts=[task_name], n_results=1)
         return task_nodes['metadatas'][0]
+
+    def find_decomposition(self, task_name, capabilities, state=""):
+        try:
+            with self._lock:
+                count = self.collection.count()
+                if count == 0:
+                    return None
+                result = self.collection.query(query_texts=[task_name], n_results=min(PLAN_REUSE_CANDIDATES, count),
+                                               where={"capabilities": str(capabilities)})
+        except Exception as e:
+            # Raised by chroma when nothing was stored under these capabilities
+            print(f"Plan library lookup failed for {task_name}: {e}")
+            return None
+
+        if not result['ids'] or not result['ids'][0]:
+            return None
+
+        # The nearest task whose stored state still matches, since a decomposition made for one state can be wrong
+        # in another
+        for distance, metadata in zip(result['distances'][0], result['metadatas'][0]):
+            similarity = 1 - distance
+            if similarity < self.reuse_threshold:
+                break
+            state_match = state_similarity(task_name, metadata['state'], state)
+            if state_match < self.state_threshold:
+                print(f"Not reusing stored decomposition of '{metadata['task_name']}' for '{task_name}': "
+                      f"made in a different state (overlap {state_match:.2f})")
+                continue
+            print(f"Reusing stored decomposition of '{metadata['task_name']}' for '{task_name}' "
+                  f"(similarity {similarity:.2f}, state overlap {state_match:.2f})")
+            return json.loads(metadata['decomposition'])
+        return None
@@ -0,0 +1,83 @@
+# Start-up warm-up
+# The slow subsystems (the WordNet lemmatizer, the plan library with chroma's embedding model, the LLM clients and
+# the web server) are loaded on first use. The warm-up loads all of them at once in background threads, while main.py
+# is still waiting at its input() prompts, and times each one for the start-up report.
+
+import time
+import threading
+
+
+def load_lemmatizer():
+    from LLM_utils import get_lemmatizer
+
+    get_lemmatizer()
+
+
+def load_plan_library():
+    from vector_db import VectorDB
+
+    VectorDB.shared().warm_up()
+
+
+def load_llm_clients():
+    from llm_backends import MODEL_ROUTES, get_backend, resolve_route
+
+    for backend in {resolve_route(call_site).backend for call_site in MODEL_ROUTES}:
+        get_backend(backend).warm_up()
+
+
+def load_server():
+    import server
+
+
+WARMUP_TASKS = (
+    ("lemmatizer", load_lemmatizer),
+    ("plan library", load_plan_library),
+    ("LLM clients", load_llm_clients),
+    ("web server", load_server),
+)
+
+
+class Warmup:
+    def __init__(self, tasks=WARMUP_TASKS):
+        self.tasks = tasks
+        self.timings = {}
+        self.errors = {}
+        self.waited = 0.0
+        self._threads = []
+
+    def start(self):
+        for name, load in self.tasks:
+            thread = threading.Thread(target=self._load, args=(name, load), name=f"warmup-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _load(self, name, load):
+        # Failures are only reported; the subsystem is loaded again, and fails properly, when it is first used
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            self.errors[name] = str(e)
+        self.timings[name] = time.perf_counter() - start
+
+    def wait(self):
+        start = time.perf_counter()
+        for thread in self._threads:
+            thread.join()
+        self.waited += time.perf_counter() - start
+
+
+def format_startup_report(import_time, prompt_time, ready_time, warmup=None):
+    lines = ["Startup:", f"  imports              {import_time:.3f}s"]
+    if warmup is not None:
+        for name, _ in warmup.tasks:
+            timing = warmup.timings.get(name)
+            status = f"failed: {warmup.errors[name]}" if name in warmup.errors else "in background"
+            lines.append(f"  {name:<20} {timing or 0.0:.3f}s {status}")
+        lines.append(f"  waiting for warm-up  {warmup.waited:.3f}s")
+    else:
+        lines.append("  warm-up              off, subsystems load on first use")
+    lines.append(f"  ready to plan after  {ready_time:.3f}s ({prompt_time:.3f}s of it at the prompts)")
+    return "\n".join(lines)
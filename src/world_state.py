@@ -0,0 +1,92 @@
+# Structured world state
+# The state is a set of interned fact strings instead of one free-text description. Executing a task yields
+# add/delete deltas, and prompts only carry the facts that mention what the task is about.
+
+import re
+import sys
+import json
+
+MAX_RELEVANT_FACTS = 12
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+FACT_SEPARATORS = re.compile(r"(?:[.;\n]+\s*|,\s+and\s+)")
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "of", "on", "in", "at", "to", "and", "or", "it", "its",
+    "with", "from", "by", "for", "into", "onto", "up", "down", "this", "that", "there", "has", "have", "not",
+}
+
+
+def normalize_fact(fact):
+    return " ".join(str(fact).strip().strip(".;,'\"").split())
+
+
+def content_words(text):
+    return {word for word in WORD_PATTERN.findall(str(text).lower()) if word not in STOPWORDS}
+
+
+class WorldState:
+    __slots__ = ("facts", "_hash")
+
+    def __init__(self, facts=()):
+        normalized = (normalize_fact(fact) for fact in facts)
+        self.facts = frozenset(sys.intern(fact) for fact in normalized if fact)
+        self._hash = hash(self.facts)
+
+    @classmethod
+    def from_text(cls, text):
+        if isinstance(text, WorldState):
+            return text
+        return cls(FACT_SEPARATORS.split(str(text)))
+
+    def apply(self, adds=(), deletes=()):
+        deleted = {normalize_fact(fact).lower() for fact in deletes}
+        kept = [fact for fact in self.facts if fact.lower() not in deleted]
+        return WorldState(kept + list(adds))
+
+    def relevant_to(self, text, limit=MAX_RELEVANT_FACTS):
+        # Facts sharing content words with the text, best matches first; the whole state if none match
+        words = content_words(text)
+        scored = sorted(((len(words & content_words(fact)), fact) for fact in self.facts),
+                        key=lambda item: (-item[0], item[1]))
+        relevant = [fact for score, fact in scored if score > 0][:limit]
+        return WorldState(relevant) if relevant else self
+
+    def __eq__(self, other):
+        if isinstance(other, WorldState):
+            return self.facts == other.facts
+        return NotImplemented
+
+    def __hash__(self):
+        return self._hash
+
+    def __len__(self):
+        return len(self.facts)
+
+    def __iter__(self):
+        return iter(sorted(self.facts))
+
+    def __contains__(self, fact):
+        return normalize_fact(fact) in self.facts
+
+    def __str__(self):
+        # Sorted, so that equal states always produce identical prompts (and cache keys)
+        return "; ".join(sorted(self.facts))
+
+    def __repr__(self):
+        return f"WorldState({sorted(self.facts)!r})"
+
+
+def parse_state_delta(response):
+    # Returns (adds, deletes), or None when the response is not a delta object
+    try:
+        delta = json.loads(response[response.index("{"):response.rindex("}") + 1])
+    except ValueError:
+        return None
+    if not isinstance(delta, dict):
+        return None
+
+    adds = delta.get("add", [])
+    deletes = delta.get("delete", [])
+    if not isinstance(adds, list) or not isinstance(deletes, list):
+        return None
+    return [str(fact) for fact in adds], [str(fact) for fact in deletes]